@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+
+# Benchmarks for indentphp.  Run with
+#
+#   python bench.py [name ...]
+#
+# to run all or only the named benchmarks.  Each benchmark prints one line per
+# input size so that growth with input size can be read off directly.
+
+import gc
+import sys
+import time
+
+import indentphp
+from indentphp import indentstring
+from ply import lex, yacc
+
+def timeit(f, *args):
+    """Return the best wall clock time of five runs of f(*args)."""
+    best = None
+    for i in range(5):
+        gc.disable()
+        start = time.time()
+        f(*args)
+        elapsed = time.time() - start
+        gc.enable()
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def report(name, size, seconds):
+    print '%-20s %10d bytes %9.4f s %9.2f us/KB' % (name, size, seconds,
+                                                    seconds * 1e6 * 1024 / size)
+
+# templates that are mostly inline html with a little php in between
+
+HTML_BLOCK = '''<tr class="row">
+    <td><a href="/item/42">Item &lt;42&gt;</a></td>
+    <td>if (a < b) { c(); }</td>
+</tr>
+'''
+
+def template(blocks):
+    return (HTML_BLOCK * blocks) + '<?php ;?>\n' + (HTML_BLOCK * blocks)
+
+def bench_html():
+    for blocks in (250, 500, 1000, 2000, 4000):
+        s = template(blocks)
+        report('html', len(s), timeit(indentstring, s))
+
+# php with deep, tab and space heavy indentation as found in legacy code
+
+PHP_BLOCK = '''
+				if  ( $value  ===  $other )
+				{
+						$result  =  array ( 'key'  =>  $value ,  'other'  =>  $other ) ;
+						return  $result ;
+				}
+'''
+
+def php_source(blocks):
+    return '<?php\nfunction f($value, $other)\n{\n' + (PHP_BLOCK * blocks) + '}\n?>\n'
+
+def bench_whitespace():
+    for blocks in (100, 200, 400, 800):
+        s = php_source(blocks)
+        report('whitespace', len(s), timeit(indentstring, s))
+
+# whitespace as parser tokens versus whitespace as trivia
+
+def parse(parser, s, trivia=False):
+    buffer = indentphp.tokenbuffer(s)
+    if trivia:
+        reader = buffer.reader(indentphp.token_values, indentphp.TRIVIA)
+    else:
+        reader = buffer.reader(indentphp.token_values)
+    return parser.parse(lexer=reader)
+
+def bench_trivia():
+    plain = yacc.yacc(module=indentphp, debug=0)
+    trivia = yacc.yacc(module=indentphp.TriviaGrammar(), debug=0,
+                       tabmodule='parsetab_trivia')
+    for name, parser in (('plain', plain), ('trivia', trivia)):
+        print '%-20s %5d states %6d actions %5d gotos' % (name,
+            len(parser.action),
+            sum([len(a) for a in parser.action.values()]),
+            sum([len(g) for g in parser.goto.values()]))
+    for blocks in (100, 200, 400, 800):
+        s = php_source(blocks)
+        report('parse plain', len(s), timeit(parse, plain, s))
+        report('parse trivia', len(s), timeit(parse, trivia, s, True))
+
+# long and broken string literals, such as embedded sql
+
+def lex_all(s, dispatch=True):
+    mylexer = indentphp.lexer.clone()
+    if not dispatch:
+        # fall back to the master regex for every character
+        mylexer.lexstatedispatch = {}
+        mylexer.begin('INITIAL')
+    mylexer.input(s)
+    n = 0
+    while mylexer.token():
+        n += 1
+    return n
+
+class Discard:
+    def write(self, s):
+        pass
+
+def lex_broken(s):
+    # the lexer reports the error on stderr
+    stderr = sys.stderr
+    sys.stderr = Discard()
+    try:
+        try:
+            lex_all(s)
+        except lex.LexError:
+            return
+    finally:
+        sys.stderr = stderr
+    raise AssertionError('expected a lexing error')
+
+SQL = r"""SELECT a.id, a.name FROM articles a WHERE a.title = \'it\'s\' AND a.body LIKE \'%\\%\' ORDER BY a.id;
+"""
+
+def bench_strings():
+    for lines in (5000, 10000, 20000):
+        body = SQL * lines
+        s = "<?php\n$sql = '" + body + "';\n?>\n"
+        report('string', len(s), timeit(lex_all, s))
+        s = "<?php\n$sql = '" + body + "\n"
+        report('unterminated string', len(s), timeit(lex_broken, s))
+
+DOCBLOCK = """    /**
+     * Returns the article with the given id.
+     *
+     * @param int $id the id of the article
+     * @return Article
+     */
+    // look it up
+    # in the table
+"""
+
+def bench_comments():
+    for blocks in (500, 1000, 2000):
+        s = "<?php\n" + DOCBLOCK * blocks + "?>\n"
+        report('comments', len(s), timeit(lex_all, s))
+
+# first character dispatch versus the combined master regex
+
+def bench_dispatch():
+    for blocks in (200, 400, 800):
+        s = php_source(blocks)
+        report('lex master regex', len(s), timeit(lex_all, s, False))
+        report('lex dispatch', len(s), timeit(lex_all, s))
+
+# one token at a time versus one pass over the whole input
+
+def tokenize_all(s):
+    mylexer = indentphp.lexer.clone()
+    mylexer.input(s)
+    return len(mylexer.tokenize())
+
+def token_all(s):
+    mylexer = indentphp.lexer.clone()
+    mylexer.input(s)
+    tokens = []
+    tok = mylexer.token()
+    while tok:
+        tokens.append(tok)
+        tok = mylexer.token()
+    return len(tokens)
+
+def bench_tokenize():
+    for blocks in (1000, 2000, 4000):
+        s = php_source(blocks)
+        print '%-20s %10d tokens' % ('tokenize', tokenize_all(s))
+        report('lex token()', len(s), timeit(token_all, s))
+        report('lex tokenize()', len(s), timeit(tokenize_all, s))
+
+# LexToken objects versus a columnar token buffer
+
+def token_bytes(tokens):
+    size = sys.getsizeof(tokens)
+    for tok in tokens:
+        size += sys.getsizeof(tok) + sys.getsizeof(tok.value)
+        if not hasattr(tok.__class__, '__slots__'):
+            size += sys.getsizeof(tok.__dict__)
+    return size
+
+def buffer_bytes(buffer):
+    size = 0
+    for column in (buffer.types, buffer.starts, buffer.ends):
+        size += sys.getsizeof(column)
+    return size
+
+def tokenbuffer_all(s):
+    return len(indentphp.tokenbuffer(s))
+
+def bench_buffer():
+    for blocks in (1000, 2000, 4000):
+        s = php_source(blocks)
+        mylexer = indentphp.lexer.clone()
+        mylexer.input(s)
+        tokens = mylexer.tokenize()
+        buffer = indentphp.tokenbuffer(s)
+        print '%-20s %10d tokens %10d bytes' % ('LexToken list', len(tokens),
+                                                token_bytes(tokens))
+        print '%-20s %10d tokens %10d bytes' % ('token buffer', len(buffer),
+                                                buffer_bytes(buffer))
+        report('lex tokenize()', len(s), timeit(tokenize_all, s))
+        report('lex tokenbuffer()', len(s), timeit(tokenbuffer_all, s))
+
+# master regexs versus the table driven lexer
+
+def dfa_tokenbuffer_all(s):
+    return len(indentphp.tokenbuffer(s, True))
+
+def bench_dfa():
+    from ply import dfa
+    print '%-20s %9.4f s' % ('dfa build', timeit(dfa.build, indentphp.lexer))
+    print '%-20s %9.4f s' % ('dfa load', timeit(dfa.readtab, indentphp.lexer, 'dfatab'))
+    for name, s in (('php', php_source(2000)), ('html', template(2000)),
+                    ('comments', "<?php\n" + DOCBLOCK * 1000 + "?>\n")):
+        report('re ' + name, len(s), timeit(tokenbuffer_all, s))
+        report('dfa ' + name, len(s), timeit(dfa_tokenbuffer_all, s))
+
+# tokens per second on a large file
+
+def bench_tokens():
+    s = php_source(8000)
+    mylexer = indentphp.lexer.clone()
+    mylexer.input(s)
+    tokens = mylexer.tokenize()
+    n = len(tokens)
+    print '%-20s %10d bytes %10d tokens' % ('input', len(s), n)
+    print '%-20s %10d bytes/token' % ('LexToken', token_bytes(tokens) / n)
+    del tokens
+    for name, f in (('token()', lex_all), ('tokenize()', tokenize_all),
+                    ('tokenbuffer()', tokenbuffer_all)):
+        seconds = timeit(f, s)
+        print '%-20s %10d tokens/s' % (name, n / seconds)
+
+# lexing an edited file again
+
+def bench_relex():
+    s = php_source(8000)
+    buffer = indentphp.tokenbuffer(s)
+    middle = s.find(';', len(s) / 2) + 1
+    for name, edit in (('insert char', s[:middle] + 'x' + s[middle:]),
+                       ('replace char', s[:middle] + 'x' + s[middle + 1:]),
+                       ('insert statement', s[:middle] + ' $b = 2;' + s[middle:]),
+                       ('append', s + '<?php $a = 1; ?>\n')):
+        report('tokenbuffer ' + name, len(s), timeit(indentphp.tokenbuffer, edit))
+        report('relex ' + name, len(s), timeit(indentphp.tokenbuffer, edit,
+                                               False, buffer))
+
+# parser tokens per second and table sizes
+
+def table_bytes(tables):
+    size = sys.getsizeof(tables)
+    for row in tables.values():
+        size += sys.getsizeof(row)
+    return size
+
+def parse_buffer(buffer, parser):
+    reader = buffer.reader(indentphp.token_values)
+    return parser.parse(lexer=reader)
+
+def build_parser():
+    return yacc.yacc(module=indentphp, debug=0)
+
+def load_standalone():
+    import phpparser
+    return reload(phpparser).bind(indentphp)
+
+def bench_parser():
+    p = build_parser()
+    print '%-20s %10d bytes' % ('dict tables',
+                                table_bytes(p.action) + table_bytes(p.goto))
+    print '%-20s %10d bytes' % ('array tables', sum([a.buffer_info()[1] * a.itemsize
+        for a in (p.abase, p.acheck, p.avalue, p.gbase, p.gvalue)]))
+    s = php_source(2000)
+    buffer = indentphp.tokenbuffer(s)
+    seconds = timeit(parse_buffer, buffer, p)
+    print '%-20s %10d tokens/s' % ('parse()', len(buffer) / seconds)
+    trace = []
+    p.parse(lexer=buffer.reader(indentphp.token_values), trace=trace)
+    print '%-20s %10d of %d states' % ('default reductions',
+        len([t for t in p.defaults if t]), len(p.defaults))
+    print '%-20s %10d of %d actions' % ('without lookahead',
+        len([1 for state, ltype, t in trace if ltype == '$default']), len(trace))
+
+# the table driven parser from yacc() against the standalone module
+# phpparser.py.  Without .pyc files loading the module includes compiling it.
+
+def bench_standalone():
+    print '%-20s %9.4f s' % ('yacc()', timeit(build_parser))
+    print '%-20s %9.4f s' % ('load phpparser', timeit(load_standalone))
+    s = php_source(2000)
+    buffer = indentphp.tokenbuffer(s)
+    for name, parser in (('table driven', build_parser()),
+                         ('standalone', load_standalone())):
+        seconds = timeit(parse_buffer, buffer, parser)
+        print '%-20s %10d tokens/s' % (name, len(buffer) / seconds)
+
+# many small files in one process
+
+def format_rebuilt(texts):
+    # what indentstring did before the Formatter: build the parser for
+    # every file
+    for s in texts:
+        mylexer = indentphp.lexer.clone()
+        mylexer.input(s)
+        reader = mylexer.tokenbuffer().reader(indentphp.token_values)
+        res = yacc.yacc(module=indentphp).parse(lexer=reader)
+        res.out(indentphp.Config())
+
+def format_reused(texts):
+    for res in indentphp.Formatter().format_many(texts):
+        pass
+
+def bench_many():
+    for files in (100, 1000):
+        texts = [php_source(1)] * files
+        size = len(texts[0]) * files
+        report('%d files rebuilt' % files, size, timeit(format_rebuilt, texts))
+        report('%d files reused' % files, size, timeit(format_reused, texts))
+
+benchmarks = [
+    ('html', bench_html),
+    ('whitespace', bench_whitespace),
+    ('trivia', bench_trivia),
+    ('strings', bench_strings),
+    ('comments', bench_comments),
+    ('dispatch', bench_dispatch),
+    ('tokenize', bench_tokenize),
+    ('buffer', bench_buffer),
+    ('dfa', bench_dfa),
+    ('tokens', bench_tokens),
+    ('relex', bench_relex),
+    ('parser', bench_parser),
+    ('standalone', bench_standalone),
+    ('many', bench_many),
+]
+
+def main():
+    names = sys.argv[1:]
+    for name, f in benchmarks:
+        if not names or name in names:
+            f()
+
+if __name__ == '__main__':
+    main()
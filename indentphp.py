@@ -37,6 +37,9 @@ class Config:
 from ply import lex, yacc
 from ply.lex import TOKEN
 import re
+import os
+import sys
+import mmap
 
 states = (
     ('php','exclusive'),
@@ -46,10 +49,8 @@ tokens = (
     'SCRIPTSTART',
     'SCRIPTSHORTSTART',
     'SCRIPTEND',
-    'NEWLINE',
-    'SPACE',
-    'TAB',
-    'HTMLCHAR',
+    'WHITESPACE',
+    'INLINE_HTML',
     'FUNCTION',
     'IDENTIFIER',
     'LPAREN',
@@ -103,7 +104,8 @@ tokens = (
     'EXCL',
     'TILDE',
     'DOT',
-    'AT'
+    'AT',
+    'COMMENT'
 )
 
 @TOKEN(r'<\?php')
@@ -116,6 +118,21 @@ def t_SCRIPTSHORTSTART(t):
     t.lexer.begin('php')
     return t
 
+# Everything outside of <? ... ?> is one INLINE_HTML token.  The rule only
+# matches the first character of the html region, a <? there is taken by the
+# rules above.  The end of the region is found with a plain string search for
+# the next <?.  The end of a php region is left to the php rules because ?>
+# may also appear inside of strings.
+
+@TOKEN(r'.')
+def t_INLINE_HTML(t):
+    end = t.lexer.lexdata.find('<?', t.lexer.lexpos)
+    if end < 0:
+        end = t.lexer.lexlen
+    t.value = t.lexer.lexdata[t.lexpos:end]
+    t.lexer.lexpos = end
+    return t
+
 @TOKEN(r'\?>')
 def t_php_SCRIPTEND(t):
     t.lexer.begin('INITIAL')
@@ -158,9 +175,126 @@ def t_php_IDENTIFIER(t):
     t.type = reserved.get(t.value, 'IDENTIFIER')
     return t
 
-@TOKEN(r'(\n|\r|\r\n)')
-def t_php_NEWLINE(t):
-    t.lexer.lineno += 1
+def newlines(s):
+    # \r\n is one line break, so a \r only counts if no \n follows it
+    return s.count('\n') + s.count('\r') - s.count('\r\n')
+
+# Line numbers are not counted while lexing.  Where one is needed it is looked
+# up from the token position in the line index of the input, see lines().
+
+t_php_WHITESPACE = r'[ \t\r\n]+'
+
+# Quoted strings are scanned by hand.  The rules only match the opening quote,
+# scan_string() then jumps from backslash to backslash with str.find until it
+# reaches the closing quote, so long literals cost a handful of searches and
+# unterminated ones fail after a single pass over the rest of the file.
+
+def scan_string(t, quote):
+    lexer = t.lexer
+    data = lexer.lexdata
+    pos = lexer.lexpos
+    end = data.find(quote, pos)
+    while end >= 0:
+        backslash = data.find('\\', pos, end)
+        if backslash < 0:
+            break
+        # skip the escaped character, which may be the quote we found
+        pos = backslash + 2
+        if pos > end:
+            end = data.find(quote, pos)
+    if end < 0:
+        if not lexer.lexeof:
+            # the rest of the string is not read yet, see lex.StreamLexer
+            lexer.lexpos = lexer.lexlen
+            return t
+        t_php_error(t)
+        raise lex.LexError("Unterminated string starting at index %d" %
+                           (lexer.lexoffset + t.lexpos),
+                           data[t.lexpos:])
+    t.value = data[t.lexpos:end + 1]
+    lexer.lexpos = end + 1
+    return t
+
+def unescaped(s, c):
+    """Return whether s contains c without a backslash in front of it."""
+    i = s.find(c)
+    while i >= 0:
+        j = i
+        while j > 0 and s[j - 1] == '\\':
+            j -= 1
+        if (i - j) % 2 == 0:
+            return True
+        i = s.find(c, i + 1)
+    return False
+
+@TOKEN(r'"')
+def t_php_CONSTANT_DQ_STRING(t):
+    scan_string(t, '"')
+    # variables in double quoted strings are not supported yet
+    if unescaped(t.value, '$'):
+        t_php_error(t)
+        raise lex.LexError("Variable in string starting at index %d" %
+                           (t.lexer.lexoffset + t.lexpos),
+                           t.lexer.lexdata[t.lexpos:])
+    return t
+
+@TOKEN(r"'")
+def t_php_CONSTANT_SQ_STRING(t):
+    return scan_string(t, "'")
+
+# Comments are found like strings: the rule only matches the comment opener
+# and the end is a plain string search for the terminator.  The token value is
+# a Span of the source, the text is only copied out and re-indented when the
+# comment is written.
+
+class Span(object):
+    """The part of data from start to end, copied out by str()."""
+    __slots__ = ('data', 'start', 'end')
+
+    def __init__(self, data, start, end):
+        self.data = data
+        self.start = start
+        self.end = end
+
+    def __str__(self):
+        return self.data[self.start:self.end]
+
+    def __len__(self):
+        return self.end - self.start
+
+    def count(self, sub):
+        if isinstance(self.data, str):
+            return self.data.count(sub, self.start, self.end)
+        # an mmap has no count()
+        return str(self).count(sub)
+
+@TOKEN(r'//|\#|/\*')
+def t_php_COMMENT(t):
+    lexer = t.lexer
+    data = lexer.lexdata
+    pos = lexer.lexpos
+    if t.value == '/*':
+        end = data.find('*/', pos)
+        if end >= 0:
+            end += 2
+        elif not lexer.lexeof:
+            end = lexer.lexlen
+        else:
+            t_php_error(t)
+            raise lex.LexError("Unterminated comment starting at index %d" %
+                               (lexer.lexoffset + t.lexpos),
+                               data[t.lexpos:])
+    else:
+        # one line comments end at the line break or at ?>
+        end = data.find('\n', pos)
+        if end < 0:
+            end = lexer.lexlen
+        for stop in ('\r', '?>'):
+            i = data.find(stop, pos, end)
+            if i >= 0:
+                end = i
+    t.value = Span(data, t.lexpos, end)
+    lexer.lexpos = end
     return t
 
 t_php_RBRACE = r'}'
@@ -184,23 +318,73 @@ t_php_PLUS = r'\+'
 t_php_MINUS = r'-'
 t_php_COLON = r':'
 t_php_DOUBLECOLON = r'::'
-t_php_SPACE = r'\ '
-t_php_TAB = r'\t'
 t_php_QUESTION = r'\?'
 t_php_LSQBRACKET = r'\['
 t_php_RSQBRACKET = r'\]'
 t_php_VARIABLE = r'\$[a-zA-Z_][a-zA-Z_0-9]*'
-t_php_CONSTANT_DQ_STRING = r'"([^$"\\]|(\\.))*"'
-t_php_CONSTANT_SQ_STRING = r'\'([^$\'\\]|(\\.))*\''
-t_HTMLCHAR = r'.'
 
 def t_error(t):
-    print 'lexing error on line %d' % t.lexer.lineno
+    print >>sys.stderr, 'lexing error on line %d, column %d' % t.lexer.lines().position(t.lexpos)
 
 def t_php_error(t):
-    print 'lexing error in php on line %d' % t.lexer.lineno
+    print >>sys.stderr, 'lexing error in php on line %d, column %d' % t.lexer.lines().position(t.lexpos)
+
+# the lexer is cached in lextab.py next to this file and only rebuilt when the
+# rules above change
+lexer = lex.lex(debug=0, reflags=re.S, optimize=1,
+                outputdir=os.path.dirname(os.path.abspath(__file__)))
+
+# The whole input is lexed in one go into a TokenBuffer, which only keeps the
+# type and the offsets of the tokens.  Token values are made from the source
+# when the parser reads the tokens.  Tokens that tend to be long or that are
+# thrown away get a Span, the others a copy of their text.
+
+token_values = {
+    'INLINE_HTML'        : Span,
+    'WHITESPACE'         : Span,
+    'CONSTANT_DQ_STRING' : Span,
+    'CONSTANT_SQ_STRING' : Span,
+    'COMMENT'            : Span,
+}
+
+# The table driven lexer is made from the same rules on first use.  Its tables
+# are cached in dfatab.py next to this file.
+
+dfalexer = None
+
+def get_dfalexer():
+    global dfalexer
+    if dfalexer is None:
+        from ply import dfa
+        dfalexer = dfa.dfa(lexer,
+                           outputdir=os.path.dirname(os.path.abspath(__file__)))
+    return dfalexer
+
+def newlexer(usedfa=False):
+    # sometimes we parse several files in one run
+    # so we use a throw-away clone of the initial lexer with a clean state
+    if usedfa:
+        return get_dfalexer().clone()
+    return lexer.clone()
+
+def tokenbuffer(s, usedfa=False, previous=None):
+    """Return the token buffer of s.  previous may be the token buffer of an
+    earlier version of s, then only the edited part is lexed again."""
+    mylexer = newlexer(usedfa)
+    if previous is not None:
+        return previous.relex(mylexer, s)
+    mylexer.input(s)
+    return mylexer.tokenbuffer()
+
+# trivia
+#
+# Whitespace carries no meaning for the grammar, so it need not be sent to the
+# parser at all.  The output is indented from scratch, so nothing needs the
+# whitespace either.  It stays in the token buffer, between the tokens around
+# it, and the reader of the buffer passes over it.  The reader's leading()
+# and trailing() tell which of it belongs before and after each token.
 
-lexer = lex.lex(debug=0, reflags=re.S)
+TRIVIA = ('WHITESPACE',)
 
 # parser
 
@@ -282,6 +466,11 @@ def p_top_statement(p):
     """
     p[0] = p[1]
 
+def p_top_statement_comment(p):
+    """top_statement : COMMENT opt_whitespace
+    """
+    p[0] = Comment(p[1])
+
 def p_statement_1(p):
     """statement : LBRACE opt_whitespace statement_list RBRACE opt_whitespace
     """
@@ -435,6 +624,56 @@ def p_else_single_2(p):
     """else_single : ELSE opt_whitespace statement"""
     p[0] = p[3]
 
+# Operator expressions are parsed as a flat list of operands, prefix and
+# infix operators, and built into a tree by precedence climbing.  Higher
+# precedence binds tighter, all binary operators are left associative and
+# assignment is right associative, as in PHP.
+
+ASSIGN_PRECEDENCE = 0
+TERNARY_PRECEDENCE = 1
+INFIX_PRECEDENCE = {
+    '||': 2,
+    '&&': 3,
+    '==': 4,
+    '===': 4,
+    '.': 5,
+}
+UNARY_PRECEDENCE = 6
+
+def operation_tree(items):
+    """Build the expression tree for a flat operation list."""
+    return climb(items, 0, -1)[0]
+
+def climb(items, i, minprec):
+    """Build the expression starting at items[i] up to the first infix
+    operator not binding tighter than minprec.  Return the expression and
+    the index of that operator."""
+    item = items[i]
+    if item.__class__ is tuple:
+        op, variable = item
+        if variable is not None:
+            rhs, i = climb(items, i + 1, ASSIGN_PRECEDENCE)
+            lhs = AssignExpr(variable, False, rhs)
+        else:
+            operand, i = climb(items, i + 1, UNARY_PRECEDENCE)
+            if op == '@':
+                lhs = AtExpr(operand)
+            else:
+                lhs = UnaryExpr(op, operand)
+    else:
+        lhs = item
+        i += 1
+    while i < len(items):
+        prec, op, middle = items[i]
+        if prec <= minprec:
+            break
+        rhs, i = climb(items, i + 1, prec)
+        if middle is None:
+            lhs = OperationExpr(lhs, op, rhs)
+        else:
+            lhs = TernaryIfExpr(lhs, middle, rhs)
+    return lhs, i
+
 def p_expr_1(p):
     """expr : variable
     """
@@ -445,16 +684,120 @@ def p_expr_2(p):
     """
     p[0] = p[1]
 
+def p_expr_without_variable_atom(p):
+    """expr_without_variable : atom
+    """
+    p[0] = p[1]
+
+def p_expr_without_variable_operation(p):
+    """expr_without_variable : operation
+    """
+    p[0] = operation_tree(p[1])
+
+def p_operation_1(p):
+    """operation :   prefixes variable
+                   | prefixes atom
+    """
+    p[0] = p[1]
+    p[0].append(p[2])
+
+def p_operation_2(p):
+    """operation :   variable infix term
+                   | atom infix term
+    """
+    p[0] = [p[1], p[2]]
+    p[0].extend(p[3])
+
+def p_operation_3(p):
+    """operation : operation infix term
+    """
+    p[0] = p[1]
+    p[0].append(p[2])
+    p[0].extend(p[3])
+
+def p_term_1(p):
+    """term :   variable
+              | atom
+    """
+    p[0] = [p[1]]
+
+def p_term_2(p):
+    """term :   prefixes variable
+              | prefixes atom
+    """
+    p[0] = p[1]
+    p[0].append(p[2])
+
+def p_prefixes(p):
+    """prefixes :   prefix
+                  | prefixes prefix
+    """
+    if len(p) == 2:
+        p[0] = [p[1]]
+    else:
+        p[0] = p[1]
+        p[0].append(p[2])
+
+def p_prefix_1(p):
+    """prefix :   PLUS opt_whitespace
+                | MINUS opt_whitespace
+                | EXCL opt_whitespace
+                | TILDE opt_whitespace
+                | AT opt_whitespace
+    """
+#               | CLONE opt_whitespace
+#               | INC opt_whitespace
+#               | DEC opt_whitespace
+#               | INCLUDE opt_whitespace
+#               | INCLUDE_ONCE opt_whitespace
+#               | REQUIRE opt_whitespace
+#               | REQUIRE_ONCE opt_whitespace
+#               | PRINT opt_whitespace
+    p[0] = (p[1], None)
+
+def p_prefix_2(p):
+    """prefix : variable ASSIGN opt_whitespace
+    """
+    p[0] = (p[2], p[1])
+
+def p_infix_1(p):
+    """infix :   IS_IDENTICAL opt_whitespace
+               | BOOLEAN_AND opt_whitespace
+               | IS_EQUAL opt_whitespace
+               | BOOLEAN_OR opt_whitespace
+               | DOT opt_whitespace
+    """
+#              | LOGICAL_OR opt_whitespace
+#              | LOGICAL_AND opt_whitespace
+#              | LOGICAL_XOR opt_whitespace
+#              | PIPE opt_whitespace
+#              | AMPERSAND opt_whitespace
+#              | CARET opt_whitespace
+#              | PLUS opt_whitespace
+#              | MINUS opt_whitespace
+#              | STAR opt_whitespace
+#              | SLASH opt_whitespace
+#              | PERCENT opt_whitespace
+#              | SL opt_whitespace
+#              | SR opt_whitespace
+#              | IS_NOT_IDENTICAL opt_whitespace
+#              | IS_NOT_EQUAL opt_whitespace
+#              | SMALLER opt_whitespace
+#              | IS_SMALLER_OR_EQUAL opt_whitespace
+#              | GREATER opt_whitespace
+#              | IS_GREATER_OR_EQUAL opt_whitespace
+    p[0] = (INFIX_PRECEDENCE[p[1]], p[1], None)
+
+def p_infix_2(p):
+    """infix : QUESTION opt_whitespace expr COLON opt_whitespace
+    """
+    p[0] = (TERNARY_PRECEDENCE, p[1], p[3])
+
 #def p_expr_without_variable_1(p):
 #    """expr_without_variable : LIST opt_whitespace LPAREN opt_whitespace assignment_list RPAREN opt_whitespace ASSIGN opt_whitespace expr
 #    """
 #    p[0] = ListExpr(p[5], p[10])
 #
-def p_expr_without_variable_2(p):
-    """expr_without_variable : variable ASSIGN opt_whitespace expr
-    """
-    p[0] = AssignExpr(p[1], False, p[4])
-
 #def p_expr_without_variable_3(p):
 #    """expr_without_variable : variable ASSIGN opt_whitespace AMPERSAND opt_whitespace variable
 #    """
@@ -475,14 +818,8 @@ def p_expr_without_variable_2(p):
 #    """
 #    p[0] = CloneExpr(p[3])
 #
-def p_expr_without_variable_7(p):
-    """expr_without_variable :    expr IS_IDENTICAL opt_whitespace expr
-                                | expr BOOLEAN_AND opt_whitespace expr
-                                | expr IS_EQUAL opt_whitespace expr
-                                | expr BOOLEAN_OR opt_whitespace expr
-                                | expr DOT opt_whitespace expr
-    """
-#                               | variable PLUS_EQUAL opt_whitespace expr
+#def p_expr_without_variable_7(p):
+#    """expr_without_variable :    variable PLUS_EQUAL opt_whitespace expr
 #                               | variable MINUS_EQUAL opt_whitespace expr
 #                               | variable MUL_EQUAL opt_whitespace expr
 #                               | variable DIV_EQUAL opt_whitespace expr
@@ -493,27 +830,9 @@ def p_expr_without_variable_7(p):
 #                               | variable XOR_EQUAL opt_whitespace expr
 #                               | variable SL_EQUAL opt_whitespace expr
 #                               | variable SR_EQUAL opt_whitespace expr
-#                               | expr LOGICAL_OR opt_whitespace expr
-#                               | expr LOGICAL_AND opt_whitespace expr
-#                               | expr LOGICAL_XOR opt_whitespace expr
-#                               | expr PIPE opt_whitespace expr
-#                               | expr AMPERSAND opt_whitespace expr
-#                               | expr CARET opt_whitespace expr
-#                               | expr PLUS opt_whitespace expr
-#                               | expr MINUS opt_whitespace expr
-#                               | expr STAR opt_whitespace expr
-#                               | expr SLASH opt_whitespace expr
-#                               | expr PERCENT opt_whitespace expr
-#                               | expr SL opt_whitespace expr
-#                               | expr SR opt_whitespace expr
-#                               | expr IS_NOT_IDENTICAL opt_whitespace expr
-#                               | expr IS_NOT_EQUAL opt_whitespace expr
-#                               | expr SMALLER opt_whitespace expr
-#                               | expr IS_SMALLER_OR_EQUAL opt_whitespace expr
-#                               | expr GREATER opt_whitespace expr
-#                               | expr IS_GREATER_OR_EQUAL opt_whitespace expr
-    p[0] = OperationExpr(p[1], p[2], p[4])
-
+#    """
+#    p[0] = OperationExpr(p[1], p[2], p[4])
+#
 #def p_expr_without_variable_8(p):
 #    """expr_without_variable : variable INC opt_whitespace
 #    """
@@ -534,39 +853,11 @@ def p_expr_without_variable_7(p):
 #    """
 #    p[0] = PreDecExpr(p[3])
 #
-def p_expr_without_variable_12(p):
-    """expr_without_variable :   PLUS opt_whitespace expr
-                               | MINUS opt_whitespace expr
-                               | EXCL opt_whitespace expr
-                               | TILDE opt_whitespace expr
-    """
-    p[0] = UnaryExpr(p[1], p[3])
-
 #def p_expr_without_variable_13(p):
 #    """expr_without_variable : expr INSTANCEOF opt_whitespace class_name_reference
 #    """
 #    p[0] = InstanceOfExpr(p[1], p[4])
 #
-def p_expr_without_variable_14(p):
-    """expr_without_variable : LPAREN opt_whitespace expr RPAREN opt_whitespace
-    """
-    p[0] = ParenExpr(p[3])
-
-def p_expr_without_variable_15(p):
-    """expr_without_variable : expr QUESTION opt_whitespace expr COLON opt_whitespace expr
-    """
-    p[0] = TernaryIfExpr(p[1], p[4], p[7])
-
-def p_expr_without_variable_16(p):
-    """expr_without_variable : ISSET opt_whitespace LPAREN opt_whitespace isset_variables RPAREN opt_whitespace
-    """
-    p[0] = IssetExpr(p[5])
-
-def p_expr_without_variable_17(p):
-    """expr_without_variable : EMPTY opt_whitespace LPAREN opt_whitespace variable RPAREN opt_whitespace
-    """
-    p[0] = EmptyExpr(p[5])
-
 #def p_expr_without_variable_18(p):
 #    """expr_without_variable : INCLUDE opt_whitespace expr
 #    """
@@ -608,21 +899,6 @@ def p_expr_without_variable_17(p):
 #    """
 #    p[0] = CastExpr(p[3], p[7])
 #
-def p_expr_without_variable_24(p):
-    """expr_without_variable : AT opt_whitespace expr
-    """
-    p[0] = AtExpr(p[3])
-
-def p_expr_without_variable_25(p):
-    """expr_without_variable : scalar
-    """
-    p[0] = p[1]
-
-def p_expr_without_variable_26(p):
-    """expr_without_variable : ARRAY opt_whitespace LPAREN opt_whitespace array_pair_list RPAREN opt_whitespace
-    """
-    p[0] = ArrayExpr(p[5])
-
 #def p_expr_without_variable_27(p):
 #    """expr_without_variable : LBACKTICK opt_whitespace encaps_list RBACKTICK opt_whitespace
 #    """
@@ -633,13 +909,13 @@ def p_expr_without_variable_26(p):
 #    """
 #    p[0] = PrintExpr(p[3])
 
-def p_scalar_1(p):
-    """scalar : IDENTIFIER opt_whitespace
+def p_atom_1(p):
+    """atom : IDENTIFIER opt_whitespace
     """
     p[0] = Scalar(p[1])
 
-def p_scalar_2(p):
-    """scalar : common_scalar
+def p_atom_2(p):
+    """atom : common_scalar
     """
 #                | STRING_VARNAME???
 #                | class_constant
@@ -649,24 +925,37 @@ def p_scalar_2(p):
 #                | START_HEREDOC encaps_list END_HEREDOC
     p[0] = p[1]
 
+def p_atom_3(p):
+    """atom : LPAREN opt_whitespace expr RPAREN opt_whitespace
+    """
+    p[0] = ParenExpr(p[3])
+
+def p_atom_4(p):
+    """atom : ISSET opt_whitespace LPAREN opt_whitespace isset_variables RPAREN opt_whitespace
+    """
+    p[0] = IssetExpr(p[5])
+
+def p_atom_5(p):
+    """atom : EMPTY opt_whitespace LPAREN opt_whitespace variable RPAREN opt_whitespace
+    """
+    p[0] = EmptyExpr(p[5])
+
+def p_atom_6(p):
+    """atom : ARRAY opt_whitespace LPAREN opt_whitespace array_pair_list RPAREN opt_whitespace
+    """
+    p[0] = ArrayExpr(p[5])
+
 def p_variable_1(p):
-    """variable : base_variable_with_function_calls
+    """variable :   reference_variable
+                  | function_call
     """
+#                 | simple_indirect_reference reference_variable
+#                 | static_member
     p[0] = p[1]
 
 #def p_variable_2(p):
 #    """variable : base_variable_with_function_calls OBJECT_OPERATOR opt_whitespace object_property method_or_not variable_properties
 #    """
-#
-def p_base_variable_with_function_calls_1(p):
-    """base_variable_with_function_calls : base_variable
-    """
-    p[0] = p[1]
-
-def p_base_variable_with_function_calls_2(p):
-     """base_variable_with_function_calls : function_call
-     """
-     p[0] = p[1]
 
 def p_function_call_1(p):
     """function_call : IDENTIFIER opt_whitespace LPAREN opt_whitespace function_call_parameter_list RPAREN opt_whitespace
@@ -718,20 +1007,14 @@ def p_non_empty_function_call_parameter_list_4(p):
     else:
         p[0].append(p[4])
 
-def p_base_variable(p):
-    """base_variable :   reference_variable
-    """
-#                       | simple_indirect_reference reference_variable
-#                       | static_member
-    p[0] = p[1]
-
 def p_reference_variable(p):
-    """reference_variable :   compound_variable
+    """reference_variable :   VARIABLE opt_whitespace
                             | reference_variable LSQBRACKET opt_whitespace dim_offset RSQBRACKET opt_whitespace
     """
+#                            | DOLLAR opt_whitespace LBRACE opt_whitespace expr RBRACE opt_whitespace
 #                            | reference_variable LBRACE opt_whitespace expr RBRACE
-    if len(p) == 2:
-        p[0] = p[1]
+    if len(p) == 3:
+        p[0] = VariableExpr(p[1])
     else:
         p[0] = ArraySubscriptExpr(p[1], p[4])
 
@@ -742,12 +1025,6 @@ def p_dim_offset(p):
     if len(p) == 2:
         p[0] = p[1]
 
-def p_compound_variable(p):
-    """compound_variable :   VARIABLE opt_whitespace
-    """
-#                           | DOLLAR opt_whitespace LBRACE opt_whitespace expr RBRACE opt_whitespace
-    p[0] = VariableExpr(p[1])
-
 def p_isset_variables(p):
     """isset_variables :   variable
                          | isset_variables COMMA opt_whitespace variable
@@ -936,6 +1213,11 @@ def p_class_statement(p):
     if len(p) == 13:
         p[0] = MethodDeclaration(p[5], p[1], p[4], p[9], p[12])
 
+def p_class_statement_comment(p):
+    """class_statement : COMMENT opt_whitespace
+    """
+    p[0] = Comment(p[1])
+
 def p_variable_modifiers_1(p):
     """variable_modifiers : non_empty_member_modifiers
     """
@@ -1082,12 +1364,7 @@ def p_static_class_constant(p):
     p[0] = Scalar(p[1] + "::" + p[5])
 
 def p_whitespace(p):
-    """whitespace :   whitespace TAB
-                    | whitespace SPACE
-                    | whitespace NEWLINE
-                    | TAB
-                    | SPACE
-                    | NEWLINE
+    """whitespace : WHITESPACE
     """
     pass
 
@@ -1097,23 +1374,134 @@ def p_opt_whitespace(p):
     """
     pass
 
-def p_html_1(p):
-    """html : html HTMLCHAR
-    """
-    if p[1] is None:
-        p[0] = p[2]
-    else:
-        p[0] = p[1] + p[2]
-
-def p_html_2(p):
-    """html : HTMLCHAR
+def p_html(p):
+    """html : INLINE_HTML
     """
     p[0] = p[1]
 
-def p_error(p):
-    print 'Syntax error on line %d' % p.lexer.lineno
+# Syntax errors are reported with the line and column of the token when the
+# line index of the input is at hand, otherwise with its offset.  A Formatter
+# reports its errors itself, see Formatter.error().
+
+def syntax_error(p, lines=None):
+    if p is None:
+        print >>sys.stderr, 'Syntax error at end of input'
+        return
+    if lines is None and hasattr(getattr(p, 'lexer', None), 'lines'):
+        lines = p.lexer.lines()
+    if lines is not None:
+        print >>sys.stderr, 'Syntax error on line %d, column %d' % lines.position(p.lexpos)
+    else:
+        print >>sys.stderr, 'Syntax error at index %d' % p.lexpos
 
-yacc.yacc(debug=1)
+def p_error(p):
+    syntax_error(p)
+
+# The parser is cached as a standalone module, phpparser.py next to this file,
+# that is written by ply.yacc.lr_write_parser() and doesn't need yacc to load.
+# When it is missing or was written from an older grammar, this run uses the
+# parser from yacc and writes the module again.  So does any other failure to
+# load it, such as a module left broken by an interrupted write.
+
+def load_parser(module, modulename, **kw):
+    # the tables, the debug file and the standalone parser are all written
+    # next to this file, not into the current directory
+    outputdir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        p = __import__(modulename).bind(module)
+        if p is not None:
+            return p
+    except Exception:
+        pass
+    p = yacc.yacc(module=module, outputdir=outputdir, **kw)
+    try:
+        yacc.lr_write_parser(p, modulename, outputdir)
+    except (IOError, OSError), e:
+        print >>sys.stderr, "Unable to create '%s.py'" % modulename, e
+    return p
+
+parser = load_parser(sys.modules[__name__], 'phpparser', debug=1)
+
+# grammar variant without whitespace
+#
+# TriviaGrammar is the grammar above with the whitespace and opt_whitespace
+# symbols removed from every production.  Each production gets its own rule
+# function, which runs the original action with the symbols at their original
+# positions and None where the whitespace used to be.  Its action and
+# positions attributes tell yacc the same, so that the rule is compiled into a
+# reduction wrapper and written to the standalone parser like the others.
+
+WHITESPACE_SYMBOLS = ('whitespace', 'opt_whitespace')
+
+def productions(f):
+    """Return the (name, symbols) pairs from the docstring of rule f."""
+    res = []
+    name = None
+    for line in f.__doc__.splitlines():
+        syms = line.split()
+        if not syms:
+            continue
+        if syms[0] == '|':
+            res.append((name, syms[1:]))
+        else:
+            name = syms[0]
+            res.append((name, syms[2:]))
+    return res
+
+def trivia_rule(f, positions):
+    # positions maps the original positions to the stripped ones
+    def rule(p):
+        s = p.slice
+        q = [None] * len(positions)
+        for i, j in enumerate(positions):
+            if j is not None:
+                q[i] = s[j].value
+        f(q)
+        s[0].value = q[0]
+    rule.action = f
+    rule.positions = positions
+    return rule
+
+class TriviaGrammar:
+    def __init__(self):
+        self.tokens = [t for t in tokens if t not in TRIVIA]
+        self.start = start
+        self.p_error = p_error
+        rules = [f for name, f in globals().items()
+                 if name[:2] == 'p_' and name != 'p_error'
+                 and name[2:] not in WHITESPACE_SYMBOLS]
+        rules.sort(lambda x, y: cmp(x.func_code.co_firstlineno, y.func_code.co_firstlineno))
+        n = 0
+        for f in rules:
+            prods = productions(f)
+            if not [1 for name, syms in prods for sym in syms if sym in WHITESPACE_SYMBOLS]:
+                setattr(self, f.__name__, f)
+                continue
+            for name, syms in prods:
+                kept = [sym for sym in syms if sym not in WHITESPACE_SYMBOLS]
+                positions = [0]
+                j = 0
+                for sym in syms:
+                    if sym in WHITESPACE_SYMBOLS:
+                        positions.append(None)
+                    else:
+                        j += 1
+                        positions.append(j)
+                rule = trivia_rule(f, positions)
+                rule.__name__ = 'p_%04d_%s' % (n, f.__name__[2:])
+                rule.__doc__ = '%s : %s' % (name, ' '.join(kept))
+                setattr(self, rule.__name__, rule)
+                n += 1
+
+triviaparser = None
+
+def get_triviaparser():
+    global triviaparser
+    if triviaparser is None:
+        triviaparser = load_parser(TriviaGrammar(), 'phptriviaparser',
+                                   tabmodule='parsetab_trivia',
+                                   debugfile='parser_trivia.out')
+    return triviaparser
 
 # ast classes
 
@@ -1147,7 +1535,7 @@ class HTML:
         self.s = s
 
     def out(self, config):
-        return self.s
+        return str(self.s)
 
 # statements
 
@@ -1162,14 +1550,59 @@ class StatementList:
         if len(self.statement_list) == 0:
             return ''
         res = []
-        for statement in self.statement_list[:-1]:
-            res.append(statement.out(config))
+        blank = False
+        for statement in self.statement_list:
+            if res and statement.__class__ is Comment and statement.trailing():
+                res[-1] = res[-1][:-1] + ' ' + statement.text(config) + '\n'
+                continue
             # add empty line after certain statements if it isn't the last
-            if statement.__class__ in (IfStatement, FunctionDeclaration):
+            if blank:
                 res.append('\n')
-        res.append(self.statement_list[-1].out(config))
+            res.append(statement.out(config))
+            blank = statement.__class__ in (IfStatement, FunctionDeclaration)
         return ''.join(res)
 
+class Comment:
+    def __init__(self, span):
+        self.span = span
+
+    def trailing(self):
+        """Return whether the comment follows code on the same line."""
+        data = self.span.data
+        i = self.span.start
+        while i > 0 and data[i - 1] in ' \t':
+            i -= 1
+        return i > 0 and data[i - 1] not in '\r\n'
+
+    def column(self):
+        data = self.span.data
+        i = self.span.start
+        while i > 0 and data[i - 1] not in '\r\n':
+            i -= 1
+        return self.span.start - i
+
+    def text(self, config):
+        lines = str(self.span).splitlines()
+        if len(lines) == 1:
+            return lines[0].rstrip()
+        # docblock lines are lined up below the opening /*, other lines keep
+        # their indentation relative to it
+        column = self.column()
+        res = [lines[0].rstrip()]
+        for line in lines[1:]:
+            stripped = line.lstrip()
+            if not stripped:
+                res.append('')
+            elif stripped[0] == '*':
+                res.append(config.indent() + ' ' + stripped.rstrip())
+            else:
+                skip = min(column, len(line) - len(stripped))
+                res.append(config.indent() + line[skip:].rstrip())
+        return '\n'.join(res)
+
+    def out(self, config):
+        return config.indent() + self.text(config) + '\n'
+
 class EmptyStatement:
     def out(self, config):
         return config.indent() + ';\n'
@@ -1304,17 +1737,28 @@ class ClassDeclaration:
         res.append('{\n')
         if len(self.statement_list) > 0:
             config.incIndent()
-            res.append(self.statement_list[0].out(config))
-            for statement in self.statement_list[1:]:
-                # add empty line before certain statements if it isn't the first
-                if statement.__class__ in (MethodDeclaration,):
-                    res.append('\n')
+            statements = self.statement_list
+            for i, statement in enumerate(statements):
+                if i > 0 and statement.__class__ is Comment and statement.trailing():
+                    res[-1] = res[-1][:-1] + ' ' + statement.text(config) + '\n'
+                    continue
+                # add empty line before certain statements if it isn't the
+                # first, above the comments that document them
+                if i > 0 and not self.documents(statements[i - 1]):
+                    j = i
+                    while j < len(statements) - 1 and self.documents(statements[j]):
+                        j += 1
+                    if statements[j].__class__ in (MethodDeclaration,):
+                        res.append('\n')
                 res.append(statement.out(config))
             config.decIndent()
         res.append(config.indent())
         res.append('}\n')
         return ''.join(res)
 
+    def documents(self, statement):
+        return statement.__class__ is Comment and not statement.trailing()
+
 class ClassVariable:
     def __init__(self, name, value = None):
         self.name = name
@@ -1429,8 +1873,9 @@ class Scalar:
         self.negated = not self.negated
 
     def out(self, config):
-        res = self.value
-        if not isinstance(self.value, types.StringTypes):
+        if isinstance(self.value, (types.StringTypes, Span)):
+            res = str(self.value)
+        else:
             res = self.value.out(config)
         if self.negated:
             return '-' + res
@@ -1600,46 +2045,224 @@ class AtExpr:
 
 # main
 
-import sys
+import json
+import copy
+from collections import deque
 
-def indentstring(s):
-    # sometimes we parse several files in one run
-    # so we use a throw-away clone of the initial lexer with a clean state
-    mylexer = lexer.clone()
-    myyacc = yacc.yacc()
-    res = myyacc.parse(s, lexer=mylexer, debug=1)
-    config = Config()
-    if res is not None:
-        return res.out(config)
-    return ''
-
-def indentfile(infilename, outfilename):
+# token dump
+#
+# --tokens writes one line per token with its type, start and end offset,
+# line number and text, either tab separated or as JSON objects.  The file is
+# lexed through a lex.StreamLexer and the lines are written out in batches, so
+# memory use does not grow with the size of the file.  Line numbers are
+# counted in the token texts, the php lexer ignores no characters.
+
+TOKEN_FORMATS = ('tsv', 'jsonl')
+
+def tsv_token(type, start, end, line, text):
+    text = text.replace('\\', '\\\\').replace('\t', '\\t')
+    text = text.replace('\n', '\\n').replace('\r', '\\r')
+    return '%s\t%d\t%d\t%d\t%s\n' % (type, start, end, line, text)
+
+# the text is the only field that needs quoting, json.dumps on a whole object
+# per token would take most of the time
+quote_json = json.encoder.encode_basestring_ascii
+
+def jsonl_token(type, start, end, line, text):
+    return '{"type": "%s", "start": %d, "end": %d, "line": %d, "text": %s}\n' % (
+        type, start, end, line, quote_json(text.decode('utf-8', 'replace')))
+
+def dumptokens(f, out, format='tsv', usedfa=False, batch=4096, chunksize=65536):
+    line_f = globals()[format + '_token']
+    stream = lex.StreamLexer(newlexer(usedfa), f, chunksize)
+    mylexer = stream.lexer
+    get_token = stream.token
+    line = 1
+    lines = []
+    while 1:
+        tok = get_token()
+        if not tok:
+            break
+        # the lexer stops right behind the token it returns
+        end = mylexer.lexpos
+        text = mylexer.lexdata[tok.lexpos - stream.offset:end]
+        lines.append(line_f(tok.type, tok.lexpos, stream.offset + end, line, text))
+        if '\r' in text:
+            line += newlines(text)
+        else:
+            line += text.count('\n')
+        if len(lines) >= batch:
+            out.write(''.join(lines))
+            lines = []
+    out.write(''.join(lines))
+
+# A Formatter holds a lexer and a built parser, so that formatting many files
+# in one process builds neither more than once.  The lexer is not cloned for
+# every file, input() and resetting the state are enough.
+#
+# With trace set the last trace parser actions are kept and written to stderr
+# on a syntax error.  Each Formatter parses with its own shallow copy of the
+# shared parser, which reports syntax errors to it instead of to p_error().
+
+class Formatter:
+    def __init__(self, trivia=False, usedfa=False, trace=0):
+        self.trivia = trivia
+        self.lexer = newlexer(usedfa)
+        if trivia:
+            self.parser = copy.copy(get_triviaparser())
+        else:
+            self.parser = copy.copy(parser)
+        self.parser.errorfunc = self.error
+        self.buffer = None
+        self.trace = None
+        if trace:
+            self.trace = deque([], trace)
+
+    def format(self, s, previous=None):
+        """Return s indented.  previous may be the token buffer of an
+        earlier version of s, such as self.buffer after formatting it, then
+        only the edited part is lexed again."""
+        mylexer = self.lexer
+        mylexer.begin('INITIAL')
+        mylexer.lexstatestack = []
+        if previous is not None:
+            buffer = previous.relex(mylexer, s)
+        else:
+            mylexer.input(s)
+            buffer = mylexer.tokenbuffer()
+        self.buffer = buffer
+        if self.trivia:
+            reader = buffer.reader(token_values, TRIVIA)
+        else:
+            reader = buffer.reader(token_values)
+        if self.trace is not None:
+            self.trace.clear()
+        res = self.parser.parse(lexer=reader, trace=self.trace)
+        if res is not None:
+            return res.out(Config())
+        return ''
+
+    def format_many(self, texts):
+        for s in texts:
+            yield self.format(s)
+
+    def error(self, p):
+        syntax_error(p, self.buffer.lines())
+        if self.trace is not None:
+            print >>sys.stderr, 'last %d parser actions:' % len(self.trace)
+            self.parser.dumptrace(self.trace)
+
+formatters = {}
+
+def indentstring(s, trivia=False, usedfa=False, previous=None):
+    key = (trivia, usedfa)
+    if key not in formatters:
+        formatters[key] = Formatter(trivia, usedfa)
+    return formatters[key].format(s, previous)
+
+# Input files are mapped instead of read.  The lexer matches on the mapped
+# bytes and HTML, strings and comments stay Spans of the map until they are
+# written, so a file is never copied into one big string.
+
+def mapfile(filename):
+    """Return the contents of filename as a read-only mmap, '' if it is empty."""
+    f = open(filename, 'rb')
+    try:
+        # a file of length 0 can't be mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            return ''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+def indentfile(infilename, outfilename, trivia=False, usedfa=False):
     outf = file(outfilename, 'w')
-    instring = open(infilename).read()
+    instring = mapfile(infilename)
     if len(instring) != 0:
-        outf.write(indentstring(instring))
+        try:
+            outf.write(indentstring(instring, trivia, usedfa))
+        finally:
+            instring.close()
     outf.close()
 
+def equal(s, m, size=65536):
+    """Return whether the string s has the same contents as the mmap m."""
+    if len(s) != len(m):
+        return False
+    for i in xrange(0, len(s), size):
+        if s[i:i + size] != m[i:i + size]:
+            return False
+    return True
+
+def checkfile(filename, trivia=False, usedfa=False):
+    """Return whether filename is indented already."""
+    m = mapfile(filename)
+    if len(m) == 0:
+        return True
+    try:
+        return equal(indentstring(m, trivia, usedfa), m)
+    finally:
+        m.close()
+
+def phpfiles(names):
+    """Return the files in names, with directories replaced by the .php
+    files below them."""
+    res = []
+    for name in names:
+        if not os.path.isdir(name):
+            res.append(name)
+            continue
+        for dirpath, dirnames, filenames in os.walk(name):
+            dirnames.sort()
+            filenames.sort()
+            for filename in filenames:
+                if filename.endswith('.php'):
+                    res.append(os.path.join(dirpath, filename))
+    return res
+
 def main():
-    onlytokens = False
-    fname = sys.argv[1]
-    if sys.argv[1] == '--tokens':
-        onlytokens = True
-        fname = sys.argv[2]
-
-    s = open(fname).read()
-    if len(s) == 0:
+    args = sys.argv[1:]
+    onlytokens = '--tokens' in args
+    usedfa = '--dfa' in args
+    format = 'tsv'
+    trace = 0
+    for arg in args:
+        if arg.startswith('--format='):
+            format = arg[len('--format='):]
+        if arg.startswith('--trace='):
+            trace = int(arg[len('--trace='):])
+    if format not in TOKEN_FORMATS:
+        print >>sys.stderr, 'unknown token format %s, use one of %s' % (format, ', '.join(TOKEN_FORMATS))
+        sys.exit(2)
+    names = [arg for arg in args if not arg.startswith('--')]
+
+    # --check lists the files that are not indented yet and exits with 1 if
+    # there are any
+    if '--check' in args:
+        unchanged = True
+        for fname in phpfiles(names):
+            try:
+                ok = checkfile(fname, usedfa=usedfa)
+            except lex.LexError:
+                ok = False
+            if not ok:
+                print fname
+                unchanged = False
+        sys.exit(not unchanged)
+
+    fname = names[0]
+    if os.path.getsize(fname) == 0:
         sys.exit(1)
 
     if onlytokens:
-        lex.input(s)
-        while 1:
-            tok = lex.token()
-            if not tok:
-                break
-            print tok
+        dumptokens(open(fname, 'rb'), sys.stdout, format, usedfa)
     else:
-        sys.stdout.write(indentstring(s))
+        formatter = Formatter(usedfa=usedfa, trace=trace)
+        m = mapfile(fname)
+        try:
+            sys.stdout.write(formatter.format(m))
+        finally:
+            m.close()
 
 if __name__ == '__main__':
     main()
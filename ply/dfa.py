@@ -0,0 +1,506 @@
+#-----------------------------------------------------------------------------
+# ply: dfa.py
+#
+# A table driven lexer engine for lexers built with lex.py.
+#
+# The rules of a lex.py lexer are compiled into one deterministic automaton
+# per lexer state.  Characters are first mapped to character classes, the
+# automaton is then a flat transition table indexed by state and class.  Both
+# are stored in array objects.  The automaton finds the longest match of all
+# rules at once; when several rules match the same longest text, the one that
+# comes first in the master regex wins.
+#
+# The tables are written to a module (dfatab.py by default) and read back on
+# the next run as long as the rules haven't changed, so the automaton is only
+# built once.
+#
+# Only plain regular expressions can be compiled: literals, character sets,
+# groups, alternatives and repetitions.  Anchors, lookarounds and back
+# references raise DFAError.
+#-----------------------------------------------------------------------------
+
+__version__ = "2.3"
+
+import re, sys, types, sre_parse, array, hashlib
+import lex
+
+class DFAError(Exception): pass
+
+# Characters above 255 all fall into one extra symbol
+_OTHER = 256
+_SYMBOLS = range(257)
+
+_categories = {
+    sre_parse.CATEGORY_DIGIT     : r'\d',
+    sre_parse.CATEGORY_NOT_DIGIT : r'\D',
+    sre_parse.CATEGORY_SPACE     : r'\s',
+    sre_parse.CATEGORY_NOT_SPACE : r'\S',
+    sre_parse.CATEGORY_WORD      : r'\w',
+    sre_parse.CATEGORY_NOT_WORD  : r'\W',
+}
+
+# -----------------------------------------------------------------------------
+# _symbols()
+#
+# Return the set of symbols matched by a single character item of a parsed
+# regular expression.
+# -----------------------------------------------------------------------------
+
+def _symbols(op,av,reflags):
+    if op == sre_parse.LITERAL:
+        syms = [min(av,_OTHER)]
+    elif op == sre_parse.NOT_LITERAL:
+        syms = [s for s in _SYMBOLS if s != av]
+    elif op == sre_parse.ANY:
+        if reflags & re.S:
+            syms = _SYMBOLS
+        else:
+            syms = [s for s in _SYMBOLS if s != ord('\n')]
+    else:
+        syms = []
+        negate = 0
+        for iop, iav in av:
+            if iop == sre_parse.NEGATE:
+                negate = 1
+            elif iop == sre_parse.LITERAL:
+                syms.append(min(iav,_OTHER))
+            elif iop == sre_parse.RANGE:
+                syms.extend(range(iav[0],min(iav[1],255)+1))
+                if iav[1] > 255: syms.append(_OTHER)
+            elif iop == sre_parse.CATEGORY and _categories.has_key(iav):
+                cre = re.compile(_categories[iav])
+                syms.extend([s for s in range(256) if cre.match(chr(s))])
+                if _categories[iav][1].isupper(): syms.append(_OTHER)
+            else:
+                raise DFAError, "Unsupported character set item '%s'" % iop
+        if negate:
+            syms = [s for s in _SYMBOLS if s not in syms]
+    if reflags & re.I:
+        syms = list(syms)
+        for s in syms[:]:
+            if s < 256: syms.append(ord(chr(s).swapcase()))
+    return dict.fromkeys(syms)
+
+# -----------------------------------------------------------------------------
+# NFA class
+#
+# A nondeterministic automaton built from parsed regular expressions with the
+# usual Thompson construction.  Nodes are numbered, edges[n] is a list of
+# (symbols,target) tuples and eps[n] a list of targets reached without input.
+# -----------------------------------------------------------------------------
+
+class NFA:
+    def __init__(self,reflags):
+        self.reflags = reflags
+        self.edges = []
+        self.eps = []
+        self.accept = { }     # Dictionary mapping final nodes to rule numbers
+
+    def node(self):
+        self.edges.append([])
+        self.eps.append([])
+        return len(self.edges)-1
+
+    def add(self,items,cur):
+        for op, av in items:
+            cur = self.add_item(op,av,cur)
+        return cur
+
+    def add_item(self,op,av,cur):
+        if op in (sre_parse.LITERAL, sre_parse.NOT_LITERAL, sre_parse.ANY, sre_parse.IN):
+            end = self.node()
+            self.edges[cur].append((_symbols(op,av,self.reflags),end))
+            return end
+        if op == sre_parse.SUBPATTERN:
+            return self.add(av[-1],cur)
+        if op == sre_parse.BRANCH:
+            end = self.node()
+            for items in av[1]:
+                start = self.node()
+                self.eps[cur].append(start)
+                self.eps[self.add(items,start)].append(end)
+            return end
+        if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            lo, hi, items = av
+            for i in range(lo):
+                cur = self.add(items,cur)
+            if hi == sre_parse.MAXREPEAT:
+                loop = self.node()
+                self.eps[cur].append(loop)
+                self.eps[self.add(items,loop)].append(loop)
+                return loop
+            end = self.node()
+            for i in range(hi-lo):
+                self.eps[cur].append(end)
+                cur = self.add(items,cur)
+            self.eps[cur].append(end)
+            return end
+        raise DFAError, "Unsupported regular expression item '%s'" % op
+
+    def closure(self,nodes):
+        stack = list(nodes)
+        seen = dict.fromkeys(nodes)
+        while stack:
+            n = stack.pop()
+            for m in self.eps[n]:
+                if not seen.has_key(m):
+                    seen[m] = 1
+                    stack.append(m)
+        keys = seen.keys()
+        keys.sort()
+        return tuple(keys)
+
+# -----------------------------------------------------------------------------
+# _rules()
+#
+# Return the rules of a lexer state as a list of (name,parsed regex) tuples in
+# the order in which the master regexs try them.
+# -----------------------------------------------------------------------------
+
+def _rules(lexer,state):
+    rules = []
+    for text in lexer.lexstateretext[state]:
+        parsed = sre_parse.parse(text,re.VERBOSE | lexer.lexreflags)
+        names = { }
+        for name, i in parsed.pattern.groupdict.items():
+            names[i] = name
+        items = list(parsed)
+        if len(items) == 1 and items[0][0] == sre_parse.BRANCH:
+            alternatives = items[0][1][1]
+        else:
+            alternatives = [items]
+        for alt in alternatives:
+            op, av = list(alt)[0]
+            rules.append((names[av[0]],av[-1]))
+    return rules
+
+# -----------------------------------------------------------------------------
+# _signature()
+#
+# The tables only depend on the master regexs and the regex flags
+# -----------------------------------------------------------------------------
+
+def _signature(lexer):
+    sig = hashlib.md5()
+    sig.update(__version__)
+    sig.update(repr(lexer.lexreflags))
+    states = lexer.lexstateretext.keys()
+    states.sort()
+    for state in states:
+        sig.update(state)
+        for text in lexer.lexstateretext[state]:
+            sig.update(text)
+    return sig.hexdigest()
+
+# -----------------------------------------------------------------------------
+# build()
+#
+# Compile the rules of all states of a lexer into automaton tables.  Returns a
+# dictionary with the tables in the format written to the table module.
+# -----------------------------------------------------------------------------
+
+def build(lexer):
+    names = []
+    nameids = { }
+    nfas = { }
+    for state in lexer.lexstateretext.keys():
+        nfa = NFA(lexer.lexreflags)
+        start = nfa.node()
+        rules = _rules(lexer,state)
+        for i in range(len(rules)):
+            name, items = rules[i]
+            if not nameids.has_key(name):
+                nameids[name] = len(names)
+                names.append(name)
+            first = nfa.node()
+            nfa.eps[start].append(first)
+            nfa.accept[nfa.add(items,first)] = i
+        nfas[state] = (nfa,start,[nameids[name] for name, items in rules])
+
+    # Split the symbols into classes of symbols that no edge tells apart
+    sets = []
+    for nfa, start, ruleids in nfas.values():
+        for edges in nfa.edges:
+            for syms, target in edges:
+                sets.append(syms)
+    classmap = []
+    classes = { }
+    for s in _SYMBOLS:
+        key = tuple([syms.has_key(s) for syms in sets])
+        if not classes.has_key(key):
+            classes[key] = len(classes)
+        classmap.append(classes[key])
+    nclasses = len(classes)
+
+    # Subset construction.  State 0 is the dead state, state numbers are
+    # premultiplied by the number of classes.
+    trans = [0] * nclasses
+    accept = [-1]
+    starts = { }
+    for state, (nfa, start, ruleids) in nfas.items():
+        edges = []
+        for n in range(len(nfa.edges)):
+            edges.append([(dict.fromkeys([classmap[s] for s in syms]),target)
+                          for syms, target in nfa.edges[n]])
+        dstates = { }
+        todo = []
+        def dstate(nodes):
+            if not dstates.has_key(nodes):
+                dstates[nodes] = len(accept) * nclasses
+                final = [nfa.accept[n] for n in nodes if nfa.accept.has_key(n)]
+                if final:
+                    accept.append(ruleids[min(final)])
+                else:
+                    accept.append(-1)
+                trans.extend([0] * nclasses)
+                todo.append(nodes)
+            return dstates[nodes]
+        starts[state] = dstate(nfa.closure([start]))
+        while todo:
+            nodes = todo.pop()
+            offset = dstates[nodes]
+            for c in range(nclasses):
+                targets = []
+                for n in nodes:
+                    for cls, target in edges[n]:
+                        if cls.has_key(c): targets.append(target)
+                if targets:
+                    trans[offset + c] = dstate(nfa.closure(targets))
+
+    # The accept table is indexed with premultiplied states as well
+    accepts = [-1] * len(trans)
+    for i in range(len(accept)):
+        accepts[i * nclasses] = accept[i]
+
+    return { 'signature' : _signature(lexer),
+             'names'     : names,
+             'classmap'  : classmap,
+             'nclasses'  : nclasses,
+             'starts'    : starts,
+             'trans'     : trans,
+             'accept'    : accepts }
+
+# -----------------------------------------------------------------------------
+# writetab() / readtab()
+#
+# Write the tables to a Python module and read them back.  readtab() returns
+# None if there is no table module or if it was made for different rules.
+# -----------------------------------------------------------------------------
+
+def writetab(tables,dfatab,outputdir=""):
+    import os.path
+    filename = os.path.join(outputdir,dfatab.split(".")[-1]) + ".py"
+    tf = lex._AtomicFile(filename)
+    tf.write("# %s.py. This file automatically created by PLY (version %s). Don't edit!\n" % (dfatab,__version__))
+    keys = tables.keys()
+    keys.sort()
+    for key in keys:
+        tf.write("_%s = %s\n" % (key,repr(tables[key])))
+    tf.close()
+
+def readtab(lexer,dfatab):
+    try:
+        module = __import__(dfatab,globals(),locals(),['_signature'])
+    except ImportError:
+        return None
+    if getattr(module,'_signature',None) != _signature(lexer):
+        return None
+    tables = { }
+    for key in ('signature','names','classmap','nclasses','starts','trans','accept'):
+        tables[key] = getattr(module,'_' + key)
+    return tables
+
+# -----------------------------------------------------------------------------
+# DFALexer class
+#
+# A lex.py Lexer that finds tokens with the automaton tables instead of the
+# master regexs.  Rule functions, states, literals and error rules work just
+# the same.
+# -----------------------------------------------------------------------------
+
+class DFALexer(lex.Lexer):
+    def __init__(self):
+        lex.Lexer.__init__(self)
+        self.dfatables = None          # Tables as returned by build()
+        self.dfatrans = None           # Transition table
+        self.dfaaccept = None          # Rule name number accepted in each state
+        self.dfastart = 0              # Start state of the current lexer state
+        self.dfarules = None           # List mapping rule name numbers to (func,type)
+        self.dfatranslate = None       # String mapping characters to classes
+        self.dfaclasses = None         # Class of each input character
+
+    def settables(self,tables):
+        self.dfatables = tables
+        self.dfatrans = array.array('i',tables['trans'])
+        self.dfaaccept = array.array('h',tables['accept'])
+        classmap = tables['classmap']
+        if tables['nclasses'] <= 256:
+            self.dfatranslate = "".join([chr(c) for c in classmap[:256]])
+        else:
+            self.dfatranslate = None
+        funcs = { }
+        for state, ritem in self.lexstatere.items():
+            for cre, findex in ritem:
+                for name, i in cre.groupindex.items():
+                    funcs[name] = findex[i]
+        self.dfarules = [funcs.get(name,(None,None)) for name in tables['names']]
+        self.dfastart = tables['starts'].get(self.lexstate,0)
+
+    def clone(self,object=None):
+        c = lex.Lexer.clone(self,object)
+        c.settables(self.dfatables)
+        c.dfaclasses = self.dfaclasses
+        return c
+
+    def begin(self,state):
+        lex.Lexer.begin(self,state)
+        if self.dfatables:
+            self.dfastart = self.dfatables['starts'][state]
+
+    def input(self,s):
+        lex.Lexer.input(self,s)
+        if self.dfatranslate and not isinstance(s,types.UnicodeType):
+            # s[:] copies an mmap and is s itself for a string
+            self.dfaclasses = array.array('B',s[:].translate(self.dfatranslate))
+        else:
+            classmap = self.dfatables['classmap']
+            self.dfaclasses = [classmap[min(ord(c),_OTHER)] for c in s]
+
+    # ------------------------------------------------------------
+    # token() - Return the next token from the Lexer
+    #
+    # The same as Lexer.token(), except for how the match is found.
+    # ------------------------------------------------------------
+    def token(self):
+        lexpos    = self.lexpos
+        lexlen    = self.lexlen
+        lexignore = self.lexignore
+        lexdata   = self.lexdata
+        classes   = self.dfaclasses
+        trans     = self.dfatrans
+        accept    = self.dfaaccept
+
+        while lexpos < lexlen:
+            if lexdata[lexpos] in lexignore:
+                lexpos += 1
+                continue
+
+            # Run the automaton as far as it goes and remember the last
+            # position at which a rule matched
+            state = self.dfastart
+            pos = lexpos
+            rule = -1
+            while pos < lexlen:
+                state = trans[state + classes[pos]]
+                if not state: break
+                pos += 1
+                if accept[state] >= 0:
+                    rule = accept[state]
+                    end = pos
+
+            if rule >= 0:
+                tok = lex.LexToken()
+                tok.value = lexdata[lexpos:end]
+                tok.lexpos = lexpos
+
+                lexpos = end
+                func,tok.type = self.dfarules[rule]
+                self.lexpos = lexpos
+
+                if not func:
+                   if tok.type: return tok
+                   continue
+
+                tok.lexer = self
+                newtok = func(tok)
+
+                if not newtok:
+                    lexpos = self.lexpos
+                    continue
+
+                if self.lexdebug:
+                    if not self.lextokens.has_key(newtok.type):
+                        raise lex.LexError, ("%s:%d: Rule '%s' returned an unknown token type '%s'" % (
+                            func.func_code.co_filename, func.func_code.co_firstlineno,
+                            func.__name__, newtok.type),lexdata[lexpos:])
+
+                return newtok
+
+            # No match, see if in literals
+            if lexdata[lexpos] in self.lexliterals:
+                tok = lex.LexToken()
+                tok.value = lexdata[lexpos]
+                tok.type = tok.value
+                tok.lexpos = lexpos
+                self.lexpos = lexpos + 1
+                return tok
+
+            # No match. Call t_error() if defined.
+            if self.lexerrorf:
+                tok = lex.LexToken()
+                tok.value = self.lexdata[lexpos:]
+                tok.type = "error"
+                tok.lexer = self
+                tok.lexpos = lexpos
+                self.lexpos = lexpos
+                newtok = self.lexerrorf(tok)
+                if lexpos == self.lexpos:
+                    # Error method didn't change text position at all. This is an error.
+                    raise lex.LexError, ("Scanning error. Illegal character '%s'" % (lexdata[lexpos]), lexdata[lexpos:])
+                lexpos = self.lexpos
+                if not newtok: continue
+                return newtok
+
+            self.lexpos = lexpos
+            raise lex.LexError, ("Illegal character '%s' at index %d" % (lexdata[lexpos],self.lexoffset + lexpos), lexdata[lexpos:])
+
+        self.lexpos = lexpos + 1
+        if self.lexdata is None:
+             raise RuntimeError, "No input string given with input()"
+        return None
+
+    # ------------------------------------------------------------
+    # tokenize() - Return all remaining tokens, or add them to a
+    # TokenBuffer (see lex.Lexer.tokenize)
+    # ------------------------------------------------------------
+    def tokenize(self,buffer=None):
+        if buffer is None:
+            tokens = []
+            tok = self.token()
+            while tok:
+                tokens.append(tok)
+                tok = self.token()
+            return tokens
+        typeids = buffer.typeids
+        while 1:
+            buffer.setstate(len(buffer.types),self.lexstate,self.lexstatestack)
+            tok = self.token()
+            if not tok: break
+            buffer.types.append(typeids[tok.type])
+            buffer.starts.append(tok.lexpos)
+            buffer.ends.append(self.lexpos)
+        return buffer
+
+# -----------------------------------------------------------------------------
+# dfa()
+#
+# Return a DFALexer for a lexer built with lex.lex().  The tables are read
+# from the module dfatab if it was made for the same rules, otherwise they
+# are built and written to it.
+# -----------------------------------------------------------------------------
+
+def dfa(lexer,dfatab="dfatab",outputdir="",write_tables=1):
+    tables = readtab(lexer,dfatab)
+    if tables is None:
+        tables = build(lexer)
+        if write_tables:
+            try:
+                writetab(tables,dfatab,outputdir)
+            except (IOError,OSError),e:
+                print >>sys.stderr, "dfa: Couldn't create '%s'. %s" % (dfatab,e)
+    c = DFALexer()
+    for key, value in lexer.__dict__.items():
+        setattr(c,key,value)
+    c.settables(tables)
+    c.begin(c.lexstate)
+    return c
@@ -24,7 +24,7 @@
 
 __version__ = "2.3"
 
-import re, sys, types
+import re, sys, types, sre_parse, array, hashlib, os, bisect, mmap
 
 # Regular expression used to match valid token names
 _is_identifier = re.compile(r'^[a-zA-Z0-9_]+$')
@@ -46,10 +46,14 @@ class LexError(Exception):
          self.args = (message,)
          self.text = s
 
-# Token class
+# Token class.  The lexer attribute is only set on tokens that are passed
+# to rule functions.  Other attributes get a dictionary when first set.
+# Tokens carry no line number, it is looked up from lexpos with the
+# lines() of the lexer.
 class LexToken(object):
+    __slots__ = ('type','value','lexpos','lexer','__dict__')
     def __str__(self):
-        return "LexToken(%s,%r,%d,%d)" % (self.type,self.value,self.lineno,self.lexpos)
+        return "LexToken(%s,%r,%d)" % (self.type,self.value,self.lexpos)
     def __repr__(self):
         return str(self)
     def skip(self,n):
@@ -73,6 +77,8 @@ class Lexer:
         self.lexretext = None         # Current regular expression strings
         self.lexstatere = {}          # Dictionary mapping lexer states to master regexs
         self.lexstateretext = {}      # Dictionary mapping lexer states to regex strings
+        self.lexdispatch = {}         # Dictionary mapping first characters to master regexs
+        self.lexstatedispatch = {}    # Dictionary mapping lexer states to dispatch tables
         self.lexstate = "INITIAL"     # Current lexer state
         self.lexstatestack = []       # Stack of lexer states
         self.lexstateinfo = None      # State information
@@ -82,20 +88,24 @@ class Lexer:
         self.lexdata = None           # Actual input data (as a string)
         self.lexpos = 0               # Current position in input text
         self.lexlen = 0               # Length of the input text
+        self.lexlines = None          # LineIndex of the input text, made by lines()
+        self.lexeof = 1               # Whether lexdata holds the rest of the input
+        self.lexoffset = 0            # Offset of lexdata in the whole input
+        self.lexorigin = (1,1)        # Line and column of the start of lexdata
         self.lexerrorf = None         # Error rule (if any)
         self.lextokens = None         # List of valid tokens
         self.lexignore = ""           # Ignored characters
         self.lexliterals = ""         # Literal characters that can be passed through
         self.lexmodule = None         # Module
-        self.lineno = 1               # Current line number
         self.lexdebug = 0             # Debugging mode
         self.lexoptimize = 0          # Optimized mode
 
     def clone(self,object=None):
-        c = Lexer()
+        c = self.__class__()
         c.lexstatere = self.lexstatere
         c.lexstateinfo = self.lexstateinfo
         c.lexstateretext = self.lexstateretext
+        c.lexstatedispatch = self.lexstatedispatch
         c.lexstate = self.lexstate
         c.lexstatestack = self.lexstatestack
         c.lexstateignore = self.lexstateignore
@@ -104,9 +114,11 @@ class Lexer:
         c.lexdata = self.lexdata
         c.lexpos = self.lexpos
         c.lexlen = self.lexlen
+        c.lexlines = self.lexlines
+        c.lexoffset = self.lexoffset
+        c.lexorigin = self.lexorigin
         c.lextokens = self.lextokens
         c.lexdebug = self.lexdebug
-        c.lineno = self.lineno
         c.lexoptimize = self.lexoptimize
         c.lexliterals = self.lexliterals
         c.lexmodule   = self.lexmodule
@@ -118,17 +130,19 @@ class Lexer:
         if object:
             newtab = { }
             for key, ritem in self.lexstatere.items():
-                newre = []
-                for cre, findex in ritem:
-                     newfindex = []
-                     for f in findex:
-                         if not f or not f[0]:
-                             newfindex.append(f)
-                             continue
-                         newfindex.append((getattr(object,f[0].__name__),f[1]))
-                newre.append((cre,newfindex))
-                newtab[key] = newre
+                newtab[key] = _rebind_re(ritem,object)
             c.lexstatere = newtab
+            newtab = { }
+            for key, dispatch in self.lexstatedispatch.items():
+                newdispatch = { }
+                rebound = { }
+                for char, ritem in dispatch.items():
+                    # characters with the same rules share their regexs
+                    if not rebound.has_key(id(ritem)):
+                        rebound[id(ritem)] = _rebind_re(ritem,object)
+                    newdispatch[char] = rebound[id(ritem)]
+                newtab[key] = newdispatch
+            c.lexstatedispatch = newtab
             c.lexstateerrorf = { }
             for key, ef in self.lexstateerrorf.items():
                 c.lexstateerrorf[key] = getattr(object,ef.__name__)
@@ -141,9 +155,11 @@ class Lexer:
     # ------------------------------------------------------------
     # writetab() - Write lexer information to a table file
     # ------------------------------------------------------------
-    def writetab(self,tabfile):
-        tf = open(tabfile+".py","w")
+    def writetab(self,tabfile,signature=None,outputdir=""):
+        filename = os.path.join(outputdir,tabfile.split(".")[-1]) + ".py"
+        tf = _AtomicFile(filename)
         tf.write("# %s.py. This file automatically created by PLY (version %s). Don't edit!\n" % (tabfile,__version__))
+        tf.write("_lexsignature = %s\n" % repr(signature))
         tf.write("_lextokens    = %s\n" % repr(self.lextokens))
         tf.write("_lexreflags   = %s\n" % repr(self.lexreflags))
         tf.write("_lexliterals  = %s\n" % repr(self.lexliterals))
@@ -159,6 +175,19 @@ class Lexer:
         tf.write("_lexstatere   = %s\n" % repr(tabre))
         tf.write("_lexstateignore = %s\n" % repr(self.lexstateignore))
 
+        # The dispatch tables as lists of (characters,regexs) tuples
+        tabdispatch = { }
+        for key, dispatch in self.lexstatedispatch.items():
+             groups = { }
+             for char, lre in dispatch.items():
+                  if not groups.has_key(id(lre)):
+                       groups[id(lre)] = ([],[(cre.pattern,_funcs_to_names(findex)) for cre, findex in lre])
+                  groups[id(lre)][0].append(char)
+             titem = [("".join(chars),regexs) for chars, regexs in groups.values()]
+             titem.sort()
+             tabdispatch[key] = titem
+        tf.write("_lexstatedispatch = %s\n" % repr(tabdispatch))
+
         taberr = { }
         for key, ef in self.lexstateerrorf.items():
              if ef:
@@ -170,9 +199,15 @@ class Lexer:
 
     # ------------------------------------------------------------
     # readtab() - Read lexer information from a tab file
+    #
+    # Returns 0 without changing the lexer if the table file was
+    # written for other rules than those with the given signature.
     # ------------------------------------------------------------
-    def readtab(self,tabfile,fdict):
-        exec "import %s as lextab" % tabfile
+    def readtab(self,tabfile,fdict,signature=None):
+        lextab = __import__(tabfile,globals(),locals(),['_lexsignature'])
+        if signature is not None and getattr(lextab,'_lexsignature',None) != signature:
+            return 0
+        reflags = re.VERBOSE | lextab._lexreflags
         self.lextokens      = lextab._lextokens
         self.lexreflags     = lextab._lexreflags
         self.lexliterals    = lextab._lexliterals
@@ -184,24 +219,50 @@ class Lexer:
              titem = []
              txtitem = []
              for i in range(len(lre)):
-                  titem.append((re.compile(lre[i][0],lextab._lexreflags),_names_to_funcs(lre[i][1],fdict)))
+                  titem.append((re.compile(lre[i][0],reflags),_names_to_funcs(lre[i][1],fdict)))
                   txtitem.append(lre[i][0])
              self.lexstatere[key] = titem
              self.lexstateretext[key] = txtitem
+        self.lexstatedispatch = { }
+        for key,groups in getattr(lextab,'_lexstatedispatch',{}).items():
+             dispatch = { }
+             for chars, lre in groups:
+                  titem = [(re.compile(text,reflags),_names_to_funcs(names,fdict)) for text, names in lre]
+                  for c in chars:
+                       dispatch[c] = titem
+             self.lexstatedispatch[key] = dispatch
         self.lexstateerrorf = { }
         for key,ef in lextab._lexstateerrorf.items():
-             self.lexstateerrorf[key] = fdict[ef]
+             self.lexstateerrorf[key] = fdict.get(ef)
         self.begin('INITIAL')
+        return 1
          
     # ------------------------------------------------------------
     # input() - Push a new string into the lexer
+    #
+    # s may also be an mmap, the regular expressions match on it
+    # directly.  Rule functions then get slices of it as token values.
     # ------------------------------------------------------------
     def input(self,s):
-        if not (isinstance(s,types.StringType) or isinstance(s,types.UnicodeType)):
+        if not (isinstance(s,types.StringType) or isinstance(s,types.UnicodeType) or
+                isinstance(s,mmap.mmap)):
             raise ValueError, "Expected a string"
         self.lexdata = s
         self.lexpos = 0
         self.lexlen = len(s)
+        self.lexlines = None
+        self.lexeof = 1
+        self.lexoffset = 0
+        self.lexorigin = (1,1)
+
+    # ------------------------------------------------------------
+    # lines() - Return the LineIndex of the input text.  Its positions
+    # are those in the whole input, see StreamLexer.
+    # ------------------------------------------------------------
+    def lines(self):
+        if self.lexlines is None:
+            self.lexlines = LineIndex(self.lexdata,*self.lexorigin)
+        return self.lexlines
 
     # ------------------------------------------------------------
     # begin() - Changes the lexing state
@@ -211,6 +272,7 @@ class Lexer:
             raise ValueError, "Undefined state"
         self.lexre = self.lexstatere[state]
         self.lexretext = self.lexstateretext[state]
+        self.lexdispatch = self.lexstatedispatch.get(state,{})
         self.lexignore = self.lexstateignore.get(state,"")
         self.lexerrorf = self.lexstateerrorf.get(state,None)
         self.lexstate = state
@@ -260,20 +322,16 @@ class Lexer:
                 lexpos += 1
                 continue
 
-            # Look for a regular expression match
-            for lexre,lexindexfunc in self.lexre:
+            # Look for a regular expression match.  The dispatch table only
+            # has the rules that can start with the current character.
+            for lexre,lexindexfunc in self.lexdispatch.get(lexdata[lexpos],self.lexre):
                 m = lexre.match(lexdata,lexpos)
                 if not m: continue
 
-                # Set last match in lexer so that rules can access it if they want
-                self.lexmatch = m
-
                 # Create a token for return
                 tok = LexToken()
                 tok.value = m.group()
-                tok.lineno = self.lineno
                 tok.lexpos = lexpos
-                tok.lexer = self
 
                 lexpos = m.end()
                 i = m.lastindex
@@ -289,7 +347,11 @@ class Lexer:
                 if not callable(func):
                    break 
 
+                # Set last match in lexer so that rules can access it if they want
+                self.lexmatch = m
+
                 # If token is processed by a function, call it
+                tok.lexer = self
                 newtok = func(tok)
                 
                 # Every function must return a token, if nothing, we just move to next token
@@ -298,7 +360,7 @@ class Lexer:
                     break
                 
                 # Verify type of the token.  If not in the token map, raise an error
-                if not self.lexoptimize:
+                if self.lexdebug:
                     if not self.lextokens.has_key(newtok.type):
                         raise LexError, ("%s:%d: Rule '%s' returned an unknown token type '%s'" % (
                             func.func_code.co_filename, func.func_code.co_firstlineno,
@@ -310,8 +372,6 @@ class Lexer:
                 if lexdata[lexpos] in self.lexliterals:
                     tok = LexToken()
                     tok.value = lexdata[lexpos]
-                    tok.lineno = self.lineno
-                    tok.lexer = self
                     tok.type = tok.value
                     tok.lexpos = lexpos
                     self.lexpos = lexpos + 1
@@ -321,7 +381,6 @@ class Lexer:
                 if self.lexerrorf:
                     tok = LexToken()
                     tok.value = self.lexdata[lexpos:]
-                    tok.lineno = self.lineno
                     tok.type = "error"
                     tok.lexer = self
                     tok.lexpos = lexpos
@@ -335,13 +394,547 @@ class Lexer:
                     return newtok
 
                 self.lexpos = lexpos
-                raise LexError, ("Illegal character '%s' at index %d" % (lexdata[lexpos],lexpos), lexdata[lexpos:])
+                raise LexError, ("Illegal character '%s' at index %d" % (lexdata[lexpos],self.lexoffset + lexpos), lexdata[lexpos:])
 
         self.lexpos = lexpos + 1
         if self.lexdata is None:
              raise RuntimeError, "No input string given with input()"
         return None
+
+    # ------------------------------------------------------------
+    # tokenize() - Return a list of all remaining tokens
+    #
+    # Works like calling token() until it returns None, but the
+    # dispatch table, master regexs and ignored characters of the
+    # state are only looked up again when a rule function moves
+    # lexpos or changes the state.  Literals and errors go through
+    # token().  If buffer is given, the tokens are added to that
+    # TokenBuffer instead and it is returned.
+    # ------------------------------------------------------------
+    def tokenize(self,buffer=None):
+        if self.lexdata is None:
+             raise RuntimeError, "No input string given with input()"
+        if buffer is None:
+            tokens = []
+            append = tokens.append
+        else:
+            tokens = buffer
+            typeids = buffer.typeids
+            addtype = buffer.types.append
+            addstart = buffer.starts.append
+            addend = buffer.ends.append
+        lexdata = self.lexdata
+        lexlen = self.lexlen
+        lexpos = self.lexpos
+        while lexpos < lexlen:
+            if buffer is not None:
+                # The state only changes in rule functions, which end the
+                # loop below
+                buffer.setstate(len(buffer.types),self.lexstate,self.lexstatestack)
+            lexdispatch = self.lexdispatch
+            lexre = self.lexre
+            lexignore = self.lexignore
+            restart = 0
+            while lexpos < lexlen:
+                if lexdata[lexpos] in lexignore:
+                    lexpos += 1
+                    continue
+
+                for master,lexindexfunc in lexdispatch.get(lexdata[lexpos],lexre):
+                    m = master.match(lexdata,lexpos)
+                    if m: break
+                else:
+                    break
+
+                start = lexpos
+                lexpos = m.end()
+                func,type = lexindexfunc[m.lastindex]
+
+                if not func:
+                    if type:
+                        if buffer is None:
+                            tok = LexToken()
+                            tok.value = m.group()
+                            tok.lexpos = start
+                            tok.type = type
+                            append(tok)
+                        else:
+                            addtype(typeids[type])
+                            addstart(start)
+                            addend(lexpos)
+                    continue
+
+                tok = LexToken()
+                tok.value = m.group()
+                tok.lexpos = start
+                tok.type = type
+                tok.lexer = self
+                self.lexpos = lexpos
+                self.lexmatch = m
+                newtok = func(tok)
+                if newtok:
+                    if self.lexdebug:
+                        if not self.lextokens.has_key(newtok.type):
+                            raise LexError, ("%s:%d: Rule '%s' returned an unknown token type '%s'" % (
+                                func.func_code.co_filename, func.func_code.co_firstlineno,
+                                func.__name__, newtok.type),lexdata[lexpos:])
+                    if buffer is None:
+                        append(newtok)
+                    else:
+                        addtype(typeids[newtok.type])
+                        addstart(newtok.lexpos)
+                        addend(self.lexpos)
+
+                if self.lexpos != lexpos or self.lexre is not lexre:
+                    lexpos = self.lexpos
+                    restart = 1
+                    break
+            if restart: continue
+
+            self.lexpos = lexpos
+            if lexpos >= lexlen: break
+            tok = self.token()
+            if tok:
+                if buffer is None:
+                    append(tok)
+                else:
+                    addtype(typeids[tok.type])
+                    addstart(tok.lexpos)
+                    addend(self.lexpos)
+            lexpos = self.lexpos
+        return tokens
+
+    # ------------------------------------------------------------
+    # tokenbuffer() - Return a TokenBuffer of all remaining tokens
+    #
+    # Lexes like tokenize(), but only the type, start and end of the
+    # tokens are kept.  The end of a token is where its rule function
+    # left lexpos.  Tokens of string rules are never created as
+    # LexToken objects at all.
+    # ------------------------------------------------------------
+    def tokenbuffer(self):
+        buffer = TokenBuffer(self.lexdata,self.lextokens.keys() + list(self.lexliterals))
+        self.tokenize(buffer)
+        # The state after the last token, for input appended to it
+        buffer.setstate(len(buffer.types),self.lexstate,self.lexstatestack)
+        return buffer
         
+# -----------------------------------------------------------------------------
+# TokenBuffer class
+#
+# The tokens of a whole input stored column by column: an array of type ids
+# and arrays of start and end offsets into the source.  This takes a few bytes
+# per token instead of a LexToken object each.  The text of a token is only
+# copied out of the source when it is asked for.
+#
+#    text(i)          -  Return the text of token i
+#    type(i)          -  Return the type name of token i
+#    state(i)         -  Return the lexer state and state stack token i
+#                        was lexed in
+#    reader()         -  Return a TokenReader for the tokens
+#    relex(lexer,data) - Return a TokenBuffer for an edited version of the
+#                        source, lexing only around the edit again
+#
+# The lexer states are kept as a log of the token indices where the state
+# changes, so the state at every token is known for the price of one entry
+# per state change.
+# -----------------------------------------------------------------------------
+
+class TokenBuffer:
+    def __init__(self,data,typenames):
+        self.data = data                   # Source the offsets refer to
+        self.typenames = list(typenames)   # List mapping type ids to names
+        self.typenames.sort()
+        self.typeids = { }                 # Dictionary mapping type names to ids
+        for i in range(len(self.typenames)):
+            self.typeids[self.typenames[i]] = i
+        self.types = array.array('H')      # Type id of each token
+        self.starts = array.array('I')     # Start offset of each token
+        self.ends = array.array('I')       # End offset of each token
+        self.stateindex = array.array('I') # Token indices where the state changes
+        self.states = [ ]                  # (state, stack) from each of those on
+        self.lexlines = None               # LineIndex of data, made by lines()
+
+    def __len__(self):
+        return len(self.types)
+
+    def lines(self):
+        if self.lexlines is None:
+            self.lexlines = LineIndex(self.data)
+        return self.lexlines
+
+    def text(self,i):
+        return self.data[self.starts[i]:self.ends[i]]
+
+    def type(self,i):
+        return self.typenames[self.types[i]]
+
+    def reader(self,values=None,skip=()):
+        return TokenReader(self,values,skip)
+
+    def state(self,i):
+        return self.states[bisect.bisect_right(self.stateindex,i)-1]
+
+    def setstate(self,i,state,stack):
+        if not self.states or self.states[-1] != (state,tuple(stack)):
+            self.stateindex.append(i)
+            self.states.append((state,tuple(stack)))
+
+    # ------------------------------------------------------------
+    # relex() - Lex data, an edited version of self.data, again
+    #
+    # Lexing starts again at the last token that ends margin characters
+    # before the edit, in the state that token was lexed in, so margin
+    # must cover how far the rules look past the end of a token.  It
+    # stops as soon as the lexer is behind the edit at a place where an
+    # old token started, in the same state, because from there on the
+    # old tokens are lexed again.  Those are copied, moved by the length
+    # difference of the edit.  lexer is used for lexing and may be any
+    # clone of the lexer the buffer was made with.
+    # ------------------------------------------------------------
+    def relex(self,lexer,data,margin=64):
+        start, oldend, newend = _edit(self.data,data)
+        delta = newend - oldend
+        n = len(self.types)
+        starts = self.starts
+        ends = self.ends
+
+        # Keep the tokens that end margin characters before the edit
+        k = bisect.bisect_right(ends,start - margin)
+        buffer = TokenBuffer(data,self.typenames)
+        buffer.types = self.types[:k]
+        buffer.starts = starts[:k]
+        buffer.ends = ends[:k]
+        i = bisect.bisect_right(self.stateindex,k)
+        buffer.stateindex = self.stateindex[:i]
+        buffer.states = self.states[:i]
+
+        lexer.input(data)
+        state, stack = self.state(k)
+        lexer.begin(state)
+        lexer.lexstatestack = list(stack)
+        if k: lexer.lexpos = ends[k-1]
+        typeids = buffer.typeids
+        get_token = lexer.token
+        j = n
+        while 1:
+            buffer.setstate(len(buffer.types),lexer.lexstate,lexer.lexstatestack)
+            lexpos = lexer.lexpos
+            if lexpos >= newend:
+                # Has the old lexer been at the same place in the same state?
+                q = lexpos - delta
+                i = bisect.bisect_left(starts,q,k)
+                if i < n and (i == 0 or ends[i-1] <= q) and buffer.states[-1] == self.state(i):
+                    j = i
+                    break
+            tok = get_token()
+            if not tok: break
+            buffer.types.append(typeids[tok.type])
+            buffer.starts.append(tok.lexpos)
+            buffer.ends.append(lexer.lexpos)
+
+        # The old tokens from j on, moved by delta
+        i = len(buffer.types) - j
+        for x in range(bisect.bisect_right(self.stateindex,j),len(self.stateindex)):
+            state, stack = self.states[x]
+            buffer.setstate(self.stateindex[x] + i,state,stack)
+        buffer.types.extend(self.types[j:])
+        if delta:
+            buffer.starts.extend(array.array('I',[x + delta for x in starts[j:]]))
+            buffer.ends.extend(array.array('I',[x + delta for x in ends[j:]]))
+        else:
+            buffer.starts.extend(starts[j:])
+            buffer.ends.extend(ends[j:])
+        return buffer
+
+# -----------------------------------------------------------------------------
+# _edit()
+#
+# Return (start, oldend, newend) such that new is old with old[start:oldend]
+# replaced by new[start:newend].  The common start and end are found by
+# comparing slices of decreasing size.
+# -----------------------------------------------------------------------------
+
+def _edit(old,new):
+    oldlen = len(old)
+    newlen = len(new)
+    n = min(oldlen,newlen)
+    start = 0
+    for size in (4096,64,1):
+        while start + size <= n and old[start:start+size] == new[start:start+size]:
+            start += size
+    n = n - start
+    end = 0
+    for size in (4096,64,1):
+        while end + size <= n and old[oldlen-end-size:oldlen-end] == new[newlen-end-size:newlen-end]:
+            end += size
+    return start, oldlen - end, newlen - end
+
+# -----------------------------------------------------------------------------
+# TokenReader class
+#
+# Hands out the tokens of a TokenBuffer one at a time as LexToken objects, so
+# that a buffer can be given to the parser in place of a lexer.  values is an
+# optional dictionary mapping token types to functions f(data,start,end) that
+# make the token value, the default is the text of the token.  Tokens of the
+# types in skip are passed over without making them.  The tokens carry no
+# line number, it can be looked up from lexpos with lines().
+#
+# The skipped tokens are the trivia of the others.  leading(i) and
+# trailing(i) return the (start, end) offsets of the trivia that belong to
+# token i of the buffer: its trailing trivia run up to and including the
+# first line break after it, the rest are the leading trivia of the next
+# token.  find(tok) returns the buffer index of a token from token().
+# -----------------------------------------------------------------------------
+
+class TokenReader:
+    def __init__(self,buffer,values=None,skip=()):
+        self.buffer = buffer
+        self.values = values or { }
+        self.index = 0
+        self.skip = None              # Dictionary of the type ids to pass over
+        if skip:
+            self.skip = { }
+            for name in skip:
+                if buffer.typeids.has_key(name):
+                    self.skip[buffer.typeids[name]] = 1
+
+    def token(self):
+        i = self.index
+        buffer = self.buffer
+        types = buffer.types
+        n = len(types)
+        if self.skip:
+            skip = self.skip
+            while i < n and skip.has_key(types[i]):
+                i += 1
+        if i >= n:
+            self.index = i
+            return None
+        self.index = i + 1
+        data = buffer.data
+        start = buffer.starts[i]
+        tok = LexToken()
+        tok.type = buffer.typenames[types[i]]
+        valuef = self.values.get(tok.type)
+        if valuef:
+            tok.value = valuef(data,start,buffer.ends[i])
+        else:
+            tok.value = data[start:buffer.ends[i]]
+        tok.lexpos = start
+        return tok
+
+    def lines(self):
+        return self.buffer.lines()
+
+    def find(self,tok):
+        return bisect.bisect_left(self.buffer.starts,tok.lexpos)
+
+    def trailing(self,i):
+        buffer = self.buffer
+        types = buffer.types
+        n = len(types)
+        skip = self.skip or { }
+        j = i + 1
+        while j < n and skip.has_key(types[j]):
+            j += 1
+        if j < n:
+            end = buffer.starts[j]
+        else:
+            end = len(buffer.data)
+        start = buffer.ends[i]
+        m = _linebreak.search(buffer.data,start,end)
+        if m:
+            end = m.end()
+        return start,end
+
+    def leading(self,i):
+        types = self.buffer.types
+        skip = self.skip or { }
+        j = i - 1
+        while j >= 0 and skip.has_key(types[j]):
+            j -= 1
+        if j < 0:
+            return 0,self.buffer.starts[i]
+        return self.trailing(j)[1],self.buffer.starts[i]
+
+# -----------------------------------------------------------------------------
+# LineIndex class
+#
+# The offsets at which the lines of a string start, found in one pass over the
+# string.  \r\n, \n and a lone \r each end a line.  position() turns an offset
+# into a (line, column) pair, both counted from 1, with a binary search, so
+# that line numbers are only worked out for the few offsets that need them.
+# -----------------------------------------------------------------------------
+
+_linebreak = re.compile(r'\r\n?|\n')
+
+class LineIndex:
+    def __init__(self,data,lineno=1,column=1):
+        starts = array.array('I',[0])
+        if data.find('\r') < 0:
+            find = data.find
+            append = starts.append
+            i = find('\n')
+            while i >= 0:
+                i += 1
+                append(i)
+                i = find('\n',i)
+        else:
+            for m in _linebreak.finditer(data):
+                starts.append(m.end())
+        self.starts = starts
+        self.firstline = lineno       # Line and column data starts at
+        self.firstcolumn = column
+
+    def __len__(self):
+        return len(self.starts)
+
+    def lineno(self,pos):
+        return bisect.bisect_right(self.starts,pos) + self.firstline - 1
+
+    def position(self,pos):
+        line = bisect.bisect_right(self.starts,pos)
+        if line == 1:
+            return self.firstline, pos + self.firstcolumn
+        return line + self.firstline - 1, pos - self.starts[line-1] + 1
+
+# -----------------------------------------------------------------------------
+# StreamLexer class
+#
+# Lexes a file-like object without reading all of it at once.  The lexer is
+# given a buffer that is refilled chunk by chunk and only keeps the input from
+# the start of the current token on, so memory use depends on the chunk size
+# and the longest token instead of the size of the input.
+#
+# A token is only handed out when at least margin characters follow it in the
+# buffer, or when the buffer holds the rest of the input.  Otherwise more input
+# is read and the token is lexed again from its start, with the lexer state it
+# started in, so tokens crossing a chunk boundary come out the same as from
+# the whole input.  margin must be at least 1 and cover how far the rules look
+# past the end of a token.  Rules that search for the end of a token themselves
+# should stop at the end of the buffer instead of failing while lexer.lexeof
+# is false.
+#
+# The lexpos of the returned tokens is the offset in the whole input, while
+# lexer.lexdata and lexer.lexpos refer to the buffer starting at offset.
+# Rules see the buffer offset as lexer.lexoffset and lexer.lines() gives line
+# and column numbers in the whole input for positions in the buffer.
+# -----------------------------------------------------------------------------
+
+class StreamLexer:
+    def __init__(self,lexer,f,chunksize=65536,margin=64):
+        self.lexer = lexer
+        self.f = f
+        self.chunksize = chunksize
+        self.margin = margin
+        self.offset = 0               # Offset of the buffer in the input
+        self.limit = -1               # Last buffer offset a token may end at
+        lexer.input("")
+        lexer.lexeof = 0
+
+    # ------------------------------------------------------------
+    # refill() - Drop the buffer up to lexer.lexpos and read more
+    # ------------------------------------------------------------
+    def refill(self):
+        lexer = self.lexer
+        lexpos = lexer.lexpos
+        size = self.chunksize
+        if lexpos == 0:
+            # The token at the start of the buffer is longer than the
+            # buffer.  Double the buffer, so that a long token is only
+            # lexed again a logarithmic number of times.
+            size = max(size,lexer.lexlen)
+        chunk = self.f.read(size)
+        origin = lexer.lexorigin
+        if lexpos:
+            origin = LineIndex(lexer.lexdata[:lexpos],*origin).position(lexpos)
+        self.offset += lexpos
+        lexer.input(lexer.lexdata[lexpos:] + chunk)
+        lexer.lexoffset = self.offset
+        lexer.lexorigin = origin
+        if chunk:
+            lexer.lexeof = 0
+            self.limit = lexer.lexlen - self.margin
+        else:
+            self.limit = sys.maxint
+
+    def token(self):
+        lexer = self.lexer
+        while 1:
+            lexpos = lexer.lexpos
+            if lexpos <= self.limit:
+                state = lexer.lexstate
+                tok = lexer.token()
+                # Without the rest of the input the lexer can only stop
+                # at the end of the buffer, past the limit
+                if lexer.lexpos <= self.limit:
+                    if tok:
+                        tok.lexpos += self.offset
+                    return tok
+                # Put the lexer back to the start of the token
+                if lexer.lexstate != state:
+                    lexer.begin(state)
+                lexer.lexpos = lexpos
+            self.refill()
+
+# -----------------------------------------------------------------------------
+# _AtomicFile class
+#
+# A file that is written under a temporary name and renamed to its real name
+# when it is closed, so that readers never see a half written file, even with
+# several processes writing it at the same time.
+# -----------------------------------------------------------------------------
+
+class _AtomicFile:
+    def __init__(self,filename):
+        self.filename = filename
+        self.tmpname = "%s.%d.tmp" % (filename,os.getpid())
+        self.f = open(self.tmpname,"w")
+
+    def write(self,s):
+        self.f.write(s)
+
+    def close(self):
+        self.f.close()
+        try:
+            os.rename(self.tmpname,self.filename)
+        except OSError:
+            # Windows doesn't rename over existing files
+            try:
+                os.remove(self.filename)
+            except OSError:
+                pass
+            try:
+                os.rename(self.tmpname,self.filename)
+            except OSError:
+                os.remove(self.tmpname)
+                raise
+
+# -----------------------------------------------------------------------------
+# _signature()
+#
+# Return a hash of everything the lexer is built from: the tokens, states and
+# literals, the rule functions with their regular expressions and line
+# numbers (which give their order) and the rule strings.
+# -----------------------------------------------------------------------------
+
+def _signature(ldict,reflags):
+    sig = hashlib.md5()
+    sig.update(__version__)
+    sig.update(repr(reflags))
+    for name in ('tokens','states','literals'):
+        sig.update(repr(ldict.get(name)))
+    names = [name for name in ldict.keys() if name[:2] == 't_']
+    names.sort()
+    for name in names:
+        t = ldict[name]
+        if type(t) in (types.FunctionType, types.MethodType):
+            sig.update("%s:%d:%s" % (name,t.func_code.co_firstlineno,t.__doc__))
+        else:
+            sig.update("%s=%r" % (name,t))
+    return sig.hexdigest()
+
 # -----------------------------------------------------------------------------
 # _validate_file()
 #
@@ -450,6 +1043,147 @@ def _form_master_re(relist,reflags,ldict,toknames):
         rlist, rre = _form_master_re(relist[m:],reflags,ldict,toknames)
         return llist+rlist, lre+rre
 
+# -----------------------------------------------------------------------------
+# _rebind_re()
+#
+# Given a list of (re,findex) tuples as built by _form_master_re(), return the
+# same list with the rule functions looked up on object.
+# -----------------------------------------------------------------------------
+
+def _rebind_re(ritem,object):
+    newre = []
+    for cre, findex in ritem:
+         newfindex = []
+         for f in findex:
+             if not f or not f[0]:
+                 newfindex.append(f)
+                 continue
+             newfindex.append((getattr(object,f[0].__name__),f[1]))
+         newre.append((cre,newfindex))
+    return newre
+
+# -----------------------------------------------------------------------------
+# _first_chars()
+#
+# Return the set of characters that a match of the regular expression regex
+# can start with, or None if that can't be worked out.  Only ascii characters
+# are returned.  The result may contain characters that can't actually start a
+# match, but never misses one.
+# -----------------------------------------------------------------------------
+
+_allchars = [chr(i) for i in range(256)]
+
+_categories = {
+    sre_parse.CATEGORY_DIGIT     : r'\d',
+    sre_parse.CATEGORY_NOT_DIGIT : r'\D',
+    sre_parse.CATEGORY_SPACE     : r'\s',
+    sre_parse.CATEGORY_NOT_SPACE : r'\S',
+    sre_parse.CATEGORY_WORD      : r'\w',
+    sre_parse.CATEGORY_NOT_WORD  : r'\W',
+}
+
+def _charset(op,av):
+    if op == sre_parse.LITERAL:
+        return [unichr(av)]
+    if op == sre_parse.NOT_LITERAL:
+        return [c for c in _allchars if ord(c) != av]
+    if op == sre_parse.ANY:
+        return _allchars
+    if op == sre_parse.IN:
+        chars = []
+        negate = 0
+        for iop, iav in av:
+            if iop == sre_parse.NEGATE:
+                negate = 1
+            elif iop == sre_parse.LITERAL:
+                chars.append(unichr(iav))
+            elif iop == sre_parse.RANGE:
+                chars.extend([unichr(i) for i in range(iav[0],min(iav[1],255)+1)])
+            elif iop == sre_parse.CATEGORY and _categories.has_key(iav):
+                cre = re.compile(_categories[iav])
+                chars.extend([c for c in _allchars if cre.match(c)])
+            else:
+                return None
+        if negate:
+            return [c for c in _allchars if c not in chars]
+        return chars
+    return None
+
+def _first_chars(regex,reflags):
+    try:
+        parsed = sre_parse.parse(regex,re.VERBOSE | reflags)
+    except Exception:
+        return None
+    first = _first(list(parsed))
+    if first is None:
+        return None
+    chars, nullable = first
+    if nullable:
+        return None
+    if reflags & re.I:
+        chars = chars + [c.swapcase() for c in chars]
+    return dict.fromkeys([str(c) for c in chars if ord(c) < 128])
+
+# Returns a tuple (chars,nullable) for a parsed sequence of regex items, or
+# None if it contains an item that isn't understood.
+
+def _first(items):
+    chars = []
+    for op, av in items:
+        if op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            # zero width, lookaheads only make the set smaller
+            continue
+        if op in (sre_parse.LITERAL, sre_parse.NOT_LITERAL, sre_parse.ANY, sre_parse.IN):
+            c = _charset(op,av)
+            if c is None: return None
+            return chars + c, 0
+        if op == sre_parse.SUBPATTERN:
+            sub = _first(list(av[-1]))
+            if sub is None: return None
+            chars = chars + sub[0]
+            if not sub[1]: return chars, 0
+        elif op == sre_parse.BRANCH:
+            nullable = 0
+            for branch in av[1]:
+                sub = _first(list(branch))
+                if sub is None: return None
+                chars = chars + sub[0]
+                nullable = nullable or sub[1]
+            if not nullable: return chars, 0
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            sub = _first(list(av[2]))
+            if sub is None: return None
+            chars = chars + sub[0]
+            if av[0] > 0 and not sub[1]: return chars, 0
+        else:
+            return None
+    return chars, 1
+
+# -----------------------------------------------------------------------------
+# _form_dispatch()
+#
+# Most tokens can be told apart by their first character.  This builds a table
+# mapping each ascii character to master regexs formed from only those rules
+# that can match at that character, in their original order, so the lexer
+# doesn't try every alternative at every position.  Characters that aren't in
+# the table use the full master regex.
+# -----------------------------------------------------------------------------
+
+def _form_dispatch(relist,reflags,ldict,toknames):
+    firsts = [_first_chars(r,reflags) for r in relist]
+    groups = { }
+    dispatch = { }
+    for i in range(128):
+        c = chr(i)
+        rules = tuple([j for j in range(len(relist)) if firsts[j] is None or firsts[j].has_key(c)])
+        if not groups.has_key(rules):
+            if rules:
+                groups[rules] = _form_master_re([relist[j] for j in rules],reflags,ldict,toknames)[0]
+            else:
+                groups[rules] = []
+        dispatch[c] = groups[rules]
+    return dispatch
+
 # -----------------------------------------------------------------------------
 # def _statetoken(s,names)
 #
@@ -480,7 +1214,7 @@ def _statetoken(s,names):
 #
 # Build all of the regular expression rules from definitions in the supplied module
 # -----------------------------------------------------------------------------
-def lex(module=None,object=None,debug=0,optimize=0,lextab="lextab",reflags=0,nowarn=0):
+def lex(module=None,object=None,debug=0,optimize=0,lextab="lextab",reflags=0,nowarn=0,outputdir=""):
     global lexer
     ldict = None
     stateinfo  = { 'INITIAL' : 'inclusive'}
@@ -489,6 +1223,7 @@ def lex(module=None,object=None,debug=0,optimize=0,lextab="lextab",reflags=0,now
     lexobj = Lexer()
     lexobj.lexdebug = debug
     lexobj.lexoptimize = optimize
+    lexobj.lexreflags = reflags
     global token,input
 
     if nowarn: warn = 0
@@ -519,16 +1254,22 @@ def lex(module=None,object=None,debug=0,optimize=0,lextab="lextab",reflags=0,now
             f = f.f_back           # Walk out to our calling function
             ldict = f.f_globals    # Grab its globals dictionary
 
+    # In optimize mode the lexer is read from the lextab if that was written
+    # for the same rules.  Otherwise the lexer is built and checked as usual,
+    # and a new lextab is written.
+    signature = None
     if optimize and lextab:
+        signature = _signature(ldict,reflags)
         try:
-            lexobj.readtab(lextab,ldict)
-            token = lexobj.token
-            input = lexobj.input
-            lexer = lexobj
-            return lexobj
+            if lexobj.readtab(lextab,ldict,signature):
+                token = lexobj.token
+                input = lexobj.input
+                lexer = lexobj
+                return lexobj
         
         except ImportError:
             pass
+        optimize = 0
         
     # Get the tokens, states, and literals variables (if any)
     if (module and isinstance(module,_INSTANCETYPE)):
@@ -777,9 +1518,17 @@ def lex(module=None,object=None,debug=0,optimize=0,lextab="lextab",reflags=0,now
              lexobj.lexstatere[state].extend(lexobj.lexstatere['INITIAL'])
              lexobj.lexstateretext[state].extend(lexobj.lexstateretext['INITIAL'])
 
+    # Build the first character dispatch tables
+    for state in regexs.keys():
+        relist = regexs[state]
+        if state != "INITIAL" and stateinfo[state] == 'inclusive':
+             relist = relist + regexs['INITIAL']
+        lexobj.lexstatedispatch[state] = _form_dispatch(relist,reflags,ldict,toknames)
+
     lexobj.lexstateinfo = stateinfo
     lexobj.lexre = lexobj.lexstatere["INITIAL"]
     lexobj.lexretext = lexobj.lexstateretext["INITIAL"]
+    lexobj.lexdispatch = lexobj.lexstatedispatch["INITIAL"]
 
     # Set up ignore variables
     lexobj.lexstateignore = ignore
@@ -811,8 +1560,11 @@ def lex(module=None,object=None,debug=0,optimize=0,lextab="lextab",reflags=0,now
     lexer = lexobj
 
     # If in optimize mode, we write the lextab   
-    if lextab and optimize:
-        lexobj.writetab(lextab)
+    if signature:
+        try:
+            lexobj.writetab(lextab,signature,outputdir)
+        except (IOError,OSError),e:
+            print >>sys.stderr, "lex: Couldn't create '%s'. %s" % (lextab,e)
 
     return lexobj
 
@@ -840,13 +1592,15 @@ def runmain(lexer=None,data=None):
     _input(data)
     if lexer:
         _token = lexer.token
+        _lines = lexer.lines
     else:
         _token = token
+        _lines = globals()["lexer"].lines
         
     while 1:
         tok = _token()
         if not tok: break
-        print "(%s,%r,%d,%d)" % (tok.type, tok.value, tok.lineno,tok.lexpos)
+        print "(%s,%r,%d,%d)" % (tok.type, tok.value, _lines().lineno(tok.lexpos),tok.lexpos)
         
 
 # -----------------------------------------------------------------------------
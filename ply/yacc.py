@@ -67,7 +67,10 @@ default_lr  = 'LALR'           # Default LR table generation method
 
 error_count = 3                # Number of symbols that must be shifted to leave recovery mode
 
-import re, types, sys, cStringIO, md5, os.path
+wrap_actions = 1               # Compile grammar rules into reduction wrappers (see lr_wrap_action())
+
+import re, types, sys, cStringIO, hashlib, os.path, array, linecache, ast, textwrap, inspect
+import lex
 
 # Exception raised for yacc-related errors
 class YaccError(Exception):   pass
@@ -94,8 +97,6 @@ except AttributeError:
 # It normally has the following attributes set:
 #        .type       = Grammar symbol type
 #        .value      = Symbol value
-#        .lineno     = Starting line number
-#        .endlineno  = Ending line number (optional, set automatically)
 #        .lexpos     = Starting lex position
 #        .endlexpos  = Ending lex position (optional, set automatically)
 
@@ -109,8 +110,10 @@ class YaccSymbol(object):
 # The lineno() method returns the line number of a given
 # item (or 0 if not defined).   The linespan() method returns
 # a tuple of (startline,endline) representing the range of lines
-# for a symbol.  The lexspan() method returns a tuple (lexpos,endlexpos)
-# representing the range of positional information for a symbol.
+# for a symbol.  Both look the lines up from the lex positions in
+# the LineIndex from lines() of the lexer.  The lexspan() method
+# returns a tuple (lexpos,endlexpos) representing the range of
+# positional information for a symbol.
 
 class YaccProduction:
     def __init__(self,s,stack=None):
@@ -131,12 +134,16 @@ class YaccProduction:
         return len(self.slice)
     
     def lineno(self,n):
-        return getattr(self.slice[n],"lineno",0)
+        lexpos = getattr(self.slice[n],"lexpos",None)
+        if lexpos is None: return 0
+        return self.lexer.lines().lineno(lexpos)
 
     def linespan(self,n):
-        startline = getattr(self.slice[n],"lineno",0)
-        endline = getattr(self.slice[n],"endlineno",startline)
-        return startline,endline
+        startpos = getattr(self.slice[n],"lexpos",None)
+        if startpos is None: return 0,0
+        endpos = getattr(self.slice[n],"endlexpos",startpos)
+        lines = self.lexer.lines()
+        return lines.lineno(startpos),lines.lineno(endpos)
 
     def lexpos(self,n):
         return getattr(self.slice[n],"lexpos",0)
@@ -175,6 +182,56 @@ class Parser:
         self.goto        = { }           # LR goto table
         self.require     = { }           # Attribute require table
         self.method      = "Unknown LR"  # Table construction method used
+        self.trace       = None          # Actions recorded by parse(), if asked to
+
+    # ------------------------------------------------------------
+    # settables() - Build the integer tables parse() works with
+    #
+    # The terminals and nonterminals are numbered and the action and goto
+    # tables packed into flat arrays by row displacement (see _comb()), so
+    # the parser indexes arrays instead of looking up symbol names in a
+    # dictionary for every action.  A terminal is looked up once per token
+    # in termids, types that appear in no action get the number of the
+    # padding column behind all rows, which is an error in every state.
+    # States that only reduce by one rule are marked in defaults (see
+    # lr_default_reductions()).  Rules that lr_wrap_action() can compile get
+    # their wrapper in p.call.  parse() finds the rules in reductions as
+    # (length, goto column, name, wrapper) tuples, and in rules those it
+    # has to call with a YaccProduction.
+    # ------------------------------------------------------------
+    def settables(self,packed=None):
+        if not packed:
+            packed = lr_pack_tables(self.action,self.goto)
+        terms, nonterms, self.abase, self.acheck, self.avalue, self.gbase, self.gvalue = packed
+        self.termids = { }
+        for i in range(len(terms)):
+            self.termids[terms[i]] = i
+        self.unknownid = len(terms)
+        self.defaults = lr_default_reductions(self.action)
+        nontermids = { }
+        for i in range(len(nonterms)):
+            nontermids[nonterms[i]] = i
+        n = len(self.productions)
+        self.reductions = [None]*n
+        self.rules = [None]*n
+        self.texts = [None]*n
+        self.unwrapped = 0
+        wrappers = { }
+        for i in range(n):
+            p = self.productions[i]
+            if not p: continue
+            p.nid = nontermids.get(p.name,-1)
+            p.call = None
+            if wrap_actions and p.func:
+                key = (p.func,p.len)
+                if not wrappers.has_key(key):
+                    wrappers[key] = lr_wrap_action(p.func,p.len)
+                p.call = wrappers[key]
+            self.reductions[i] = (p.len,p.nid,p.name,p.call)
+            self.texts[i] = str(p)
+            if p.func and not p.call:
+                self.rules[i] = p.func
+                self.unwrapped = 1
 
     def errok(self):
         self.errorok     = 1
@@ -187,22 +244,41 @@ class Parser:
         self.symstack.append(sym)
         self.statestack.append(0)
 
-    def parse(self,input=None,lexer=None,debug=0,tracking=0):
+    # ------------------------------------------------------------
+    # parse() - Parse the tokens from lexer
+    #
+    # debug prints the symbol stack for every token and costs a string
+    # built from the whole stack each time.  trace is a cheaper way to see
+    # how the parser got somewhere: each action is appended to it as a
+    # (state, lookahead type, action) tuple, so a deque with a maxlen keeps
+    # the last few for dumptrace() in an error function.
+    #
+    # lr_write_parser() copies errok(), restart(), parse() and dumptrace()
+    # into the standalone parser modules.  They may only use the attributes
+    # set by settables() and the names YaccSymbol, YaccProduction,
+    # error_count, lex and sys, which those modules define as well.
+    # ------------------------------------------------------------
+    def parse(self,input=None,lexer=None,debug=0,tracking=0,trace=None):
         lookahead = None                 # Current lookahead symbol
         lookaheadstack = [ ]             # Stack of lookahead symbols
-        actions = self.action            # Local reference to action table
-        goto    = self.goto              # Local reference to goto table
-        prod    = self.productions       # Local reference to production list
-        pslice  = YaccProduction(None)   # Production object passed to grammar rules
+        termids = self.termids           # Local references to the integer tables
+        unknownid = self.unknownid
+        endid   = termids.get('$end',unknownid)
+        abase   = self.abase
+        acheck  = self.acheck
+        avalue  = self.avalue
+        gbase   = self.gbase
+        gvalue  = self.gvalue
+        defaults = self.defaults
+        reductions = self.reductions     # Local reference to the rule tuples
+        rules   = self.rules
         errorcount = 0                   # Used during error recovery
 
         # If no lexer was given, we will try to use the lex module
         if not lexer:
-            import lex
             lexer = lex.lexer
-        
-        pslice.lexer = lexer
-        pslice.parser = self
+
+        self.trace = trace
 
         # If input was supplied, pass to lexer
         if input:
@@ -216,7 +292,13 @@ class Parser:
         symstack   = [ ]                # Stack of grammar symbols
         self.symstack = symstack
 
-        pslice.stack = symstack         # Put in the production
+        # Production object passed to the grammar rules without a wrapper
+        pslice = None
+        if self.unwrapped:
+            pslice = YaccProduction(None)
+            pslice.lexer = lexer
+            pslice.parser = self
+            pslice.stack = symstack
         errtoken   = None               # Err token
 
         # The start state is assumed to be (0,$end)
@@ -226,33 +308,51 @@ class Parser:
         sym.type = '$end'
         symstack.append(sym)
         state = 0
+        tid = None                      # Terminal number of the lookahead
+        tidof = None                    # Symbol tid belongs to
         while 1:
             # Get the next symbol on the input.  If a lookahead symbol
             # is already set, we just use that. Otherwise, we'll pull
             # the next token off of the lookaheadstack or from the lexer
             if debug > 1:
                 print 'state', state
-            if not lookahead:
-                if not lookaheadstack:
-                    lookahead = get_token()     # Get the next token
-                else:
-                    lookahead = lookaheadstack.pop()
+            t = defaults[state]
+            if t and not errorcount:
+                # Default reduction, the lookahead doesn't matter.  While
+                # recovering from an error the tables are always consulted,
+                # so that states without an action on 'error' are popped.
+                ltype = '$default'
+            else:
                 if not lookahead:
-                    lookahead = YaccSymbol()
-                    lookahead.type = '$end'
+                    if not lookaheadstack:
+                        lookahead = get_token()     # Get the next token
+                    else:
+                        lookahead = lookaheadstack.pop()
+                    if not lookahead:
+                        lookahead = YaccSymbol()
+                        lookahead.type = '$end'
+
+                # Check the action table
+                ltype = lookahead.type
+                if lookahead is not tidof:
+                    tid = termids.get(ltype,unknownid)
+                    tidof = lookahead
+                i = abase[state] + tid
+                if acheck[i] == state:
+                    t = avalue[i]
+                else:
+                    t = None
             if debug:
-                errorlead = ("%s . %s" % (" ".join([xx.type for xx in symstack][1:]), str(lookahead))).lstrip()
-
-            # Check the action table
-            ltype = lookahead.type
-            t = actions[state].get(ltype)
+                errorlead = ("%s . %s" % (" ".join([xx.type for xx in symstack][1:]), str(lookahead or ltype))).lstrip()
+            if trace is not None:
+                trace.append((state,ltype,t))
 
             if debug > 1:
                 print 'action', t
             if t is not None:
                 if t > 0:
                     # shift a symbol on the stack
-                    if ltype == '$end':
+                    if tid == endid:
                         # Error, end of input
                         sys.stderr.write("yacc: Parse error. EOF\n")
                         return
@@ -269,9 +369,7 @@ class Parser:
                 
                 if t < 0:
                     # reduce a symbol on the stack, emit a production
-                    p = prod[-t]
-                    pname = p.name
-                    plen  = p.len
+                    plen, nid, pname, call = reductions[-t]
 
                     # Get production function
                     sym = YaccSymbol()
@@ -284,131 +382,486 @@ class Parser:
                         targ = symstack[-plen-1:]
                         targ[0] = sym
                         if tracking:
-                           t1 = targ[1]
-                           sym.lineno = t1.lineno
-                           sym.lexpos = t1.lexpos
+                           sym.lexpos = targ[1].lexpos
                            t1 = targ[-1]
-                           sym.endlineno = getattr(t1,"endlineno",t1.lineno)
                            sym.endlexpos = getattr(t1,"endlexpos",t1.lexpos)
                         del symstack[-plen:]
                         del statestack[-plen:]
                     else:
                         if tracking:
-                           sym.lineno = lexer.lineno
                            sym.lexpos = lexer.lexpos
                         targ = [ sym ]
-                    pslice.slice = targ
 
-                    # Call the grammar rule with our special slice object
-                    p.func(pslice)
+                    if call:
+                        # Call the compiled wrapper of the grammar rule
+                        sym.value = call(targ)
+                    else:
+                        pslice.slice = targ
+
+                        # Call the grammar rule with our special slice object
+                        rules[-t](pslice)
 
-                    # If there was a pushback, put that on the stack
-                    if pslice.pbstack:
-                        lookaheadstack.append(lookahead)
-                        for _t in pslice.pbstack:
-                            lookaheadstack.append(_t)
-                        lookahead = None
-                        pslice.pbstack = []
+                        # If there was a pushback, put that on the stack
+                        if pslice.pbstack:
+                            if lookahead:
+                                lookaheadstack.append(lookahead)
+                            for _t in pslice.pbstack:
+                                lookaheadstack.append(_t)
+                            lookahead = None
+                            pslice.pbstack = []
 
                     symstack.append(sym)
-                    state = goto[statestack[-1]][pname]
+                    state = gvalue[gbase[statestack[-1]] + nid]
                     statestack.append(state)
                     continue
 
-                if t == 0:
-                    n = symstack[-1]
-                    return getattr(n,"value",None)
-
-            if t == None:
-                if debug:
-                    sys.stderr.write(errorlead + "\n")
-                # We have some kind of parsing error here.  To handle
-                # this, we are going to push the current token onto
-                # the tokenstack and replace it with an 'error' token.
-                # If there are any synchronization rules, they may
-                # catch it.
-                #
-                # In addition to pushing the error token, we call call
-                # the user defined p_error() function if this is the
-                # first syntax error.  This function is only called if
-                # errorcount == 0.
-                if errorcount == 0 or self.errorok:
-                    errorcount = error_count
-                    self.errorok = 0
-                    errtoken = lookahead
-                    if errtoken.type == '$end':
-                        errtoken = None               # End of file!
-                    if self.errorfunc:
-                        global errok,token,restart
-                        errok = self.errok        # Set some special functions available in error recovery
-                        token = get_token
-                        restart = self.restart
-                        tok = self.errorfunc(errtoken)
-                        del errok, token, restart   # Delete special functions
-                        
-                        if self.errorok:
-                            # User must have done some kind of panic
-                            # mode recovery on their own.  The
-                            # returned token is the next lookahead
-                            lookahead = tok
-                            errtoken = None
-                            continue
-                    else:
-                        if errtoken:
-                            if hasattr(errtoken,"lineno"): lineno = lookahead.lineno
-                            else: lineno = 0
-                            if lineno:
-                                sys.stderr.write("yacc: Syntax error at line %d, token=%s\n" % (lineno, errtoken.type))
-                            else:
-                                sys.stderr.write("yacc: Syntax error, token=%s" % errtoken.type)
-                        else:
-                            sys.stderr.write("yacc: Parse error in input. EOF\n")
-                            return
+                # accept
+                return getattr(symstack[-1],"value",None)
 
+            if debug:
+                sys.stderr.write(errorlead + "\n")
+            # We have some kind of parsing error here.  To handle
+            # this, we are going to push the current token onto
+            # the tokenstack and replace it with an 'error' token.
+            # If there are any synchronization rules, they may
+            # catch it.
+            #
+            # In addition to pushing the error token, we call call
+            # the user defined p_error() function if this is the
+            # first syntax error.  This function is only called if
+            # errorcount == 0.
+            if errorcount == 0 or self.errorok:
+                errorcount = error_count
+                self.errorok = 0
+                errtoken = lookahead
+                if errtoken.type == '$end':
+                    errtoken = None               # End of file!
+                if self.errorfunc:
+                    global errok,token,restart
+                    errok = self.errok        # Set some special functions available in error recovery
+                    token = get_token
+                    restart = self.restart
+                    tok = self.errorfunc(errtoken)
+                    del errok, token, restart   # Delete special functions
+                    
+                    if self.errorok:
+                        # User must have done some kind of panic
+                        # mode recovery on their own.  The
+                        # returned token is the next lookahead
+                        lookahead = tok
+                        errtoken = None
+                        continue
                 else:
-                    errorcount = error_count
-                
-                # case 1:  the statestack only has 1 entry on it.  If we're in this state, the
-                # entire parse has been rolled back and we're completely hosed.   The token is
-                # discarded and we just keep going.
+                    if errtoken:
+                        if hasattr(errtoken,"lexpos") and hasattr(lexer,"lines"):
+                            sys.stderr.write("yacc: Syntax error at line %d, token=%s\n" % (lexer.lines().lineno(errtoken.lexpos), errtoken.type))
+                        else:
+                            sys.stderr.write("yacc: Syntax error, token=%s" % errtoken.type)
+                    else:
+                        sys.stderr.write("yacc: Parse error in input. EOF\n")
+                        return
+
+            else:
+                errorcount = error_count
+            
+            # case 1:  the statestack only has 1 entry on it.  If we're in this state, the
+            # entire parse has been rolled back and we're completely hosed.   The token is
+            # discarded and we just keep going.
+
+            if len(statestack) <= 1 and lookahead.type != '$end':
+                lookahead = None
+                errtoken = None
+                state = 0
+                # Nuke the pushback stack
+                del lookaheadstack[:]
+                continue
+
+            # case 2: the statestack has a couple of entries on it, but we're
+            # at the end of the file. nuke the top entry and generate an error token
 
-                if len(statestack) <= 1 and lookahead.type != '$end':
+            # Start nuking entries on the stack
+            if lookahead.type == '$end':
+                # Whoa. We're really hosed here. Bail out
+                return 
+
+            if lookahead.type != 'error':
+                sym = symstack[-1]
+                if sym.type == 'error':
+                    # Hmmm. Error is on top of stack, we'll just nuke input
+                    # symbol and continue
                     lookahead = None
-                    errtoken = None
-                    # Nuke the pushback stack
-                    del lookaheadstack[:]
                     continue
+                t = YaccSymbol()
+                t.type = 'error'
+                if hasattr(lookahead,"lexpos"):
+                    t.lexpos = lookahead.lexpos
+                t.value = lookahead
+                lookaheadstack.append(lookahead)
+                lookahead = t
+            else:
+                symstack.pop()
+                statestack.pop()
+                state = statestack[-1]
+
+    # ------------------------------------------------------------
+    # dumptrace() - Write the actions recorded by parse() to f
+    #
+    # Default reductions, taken without a lookahead, show $default in
+    # place of the token type.
+    # ------------------------------------------------------------
+    def dumptrace(self,trace=None,f=None):
+        if trace is None: trace = self.trace
+        if f is None: f = sys.stderr
+        for state,ltype,t in trace:
+            if t is None:
+                action = "syntax error"
+            elif t > 0:
+                action = "shift and go to state %d" % t
+            elif t < 0:
+                action = "reduce using rule %d (%s)" % (-t,self.texts[-t])
+            else:
+                action = "accept"
+            f.write("state %-5d %-20s %s\n" % (state,ltype,action))
 
-                # case 2: the statestack has a couple of entries on it, but we're
-                # at the end of the file. nuke the top entry and generate an error token
+# -----------------------------------------------------------------------------
+# lr_wrap_action()
+#
+# Compiles a grammar rule function into a wrapper for a production of
+# length plen.  The wrapper takes the symbol list the parser would have put
+# into the YaccProduction and returns the value of p[0].  Inside the rule,
+# p[0] becomes a local variable, p[n] becomes a local loaded from the n-th
+# symbol once and len(p) becomes the constant plen+1, so that none of them
+# costs a method call.  Rules that use p in any other way (p.lineno(),
+# p.lexer, p[1:], passing p on, ...) or whose source isn't available can't
+# be compiled, for those None is returned and the parser calls the rule
+# with a YaccProduction as usual.
+#
+# lr_action_source() makes the same wrapper as source code, for
+# lr_write_parser().  The rewrites are applied to the text of the rule, so
+# its comments and layout are kept.
+#
+# A rule function may run the action of another rule on a production whose
+# symbols are at other positions.  Its action attribute is that rule, and its
+# positions attribute maps each position of the action's p to a position of
+# the production, or to None for a symbol the production doesn't have, which
+# the action then reads as None.  Such rules are compiled from the source of
+# the action.
+# -----------------------------------------------------------------------------
 
-                # Start nuking entries on the stack
-                if lookahead.type == '$end':
-                    # Whoa. We're really hosed here. Bail out
-                    return 
+class _NotWrappable(Exception):
+    pass
 
-                if lookahead.type != 'error':
-                    sym = symstack[-1]
-                    if sym.type == 'error':
-                        # Hmmm. Error is on top of stack, we'll just nuke input
-                        # symbol and continue
-                        lookahead = None
-                        continue
-                    t = YaccSymbol()
-                    t.type = 'error'
-                    if hasattr(lookahead,"lineno"):
-                        t.lineno = lookahead.lineno
-                    t.value = lookahead
-                    lookaheadstack.append(lookahead)
-                    lookahead = t
-                else:
-                    symstack.pop()
-                    statestack.pop()
+class _ActionTransformer(ast.NodeTransformer):
+    def __init__(self,pname,plen,positions=None):
+        self.pname = pname
+        self.plen = plen                  # Length of the production the action was written for
+        self.positions = positions
+        self.used = { }
+        self.edits = [ ]                  # (lineno, col_offset, pattern, replacement)
+
+    def edit(self,node,pattern,replacement):
+        self.edits.append((node.lineno,node.col_offset,pattern,replacement))
+
+    def local(self,n,ctx):
+        return ast.Name(id="_p%d" % n,ctx=ctx)
+
+    def item(self,index,node):
+        # _t[index].value
+        load = ast.Load()
+        t = self.located(ast.Name(id="_t",ctx=load),node)
+        item = self.located(ast.Subscript(value=t,slice=index,ctx=load),node)
+        return self.located(ast.Attribute(value=item,attr="value",ctx=load),node)
+
+    def located(self,new,node):
+        new.lineno = node.lineno
+        new.col_offset = node.col_offset
+        return new
+
+    def visit_Subscript(self,node):
+        if not (isinstance(node.value,ast.Name) and node.value.id == self.pname):
+            return self.generic_visit(node)
+        if not (isinstance(node.slice,ast.Index) and isinstance(node.slice.value,ast.Num)):
+            raise _NotWrappable
+        n = node.slice.value.n
+        if type(n) is not int or n < 0:
+            raise _NotWrappable
+        if n > self.plen:
+            # Dead code for this production, unless it really is an IndexError
+            if not isinstance(node.ctx,ast.Load):
+                raise _NotWrappable
+            self.edit(node,r"%s\s*\[\s*%d\s*\]" % (self.pname,n),"_t[%d].value" % n)
+            return self.item(node.slice,node)
+        if n and self.positions:
+            n = self.positions[n]
+            if n is None:
+                if not isinstance(node.ctx,ast.Load):
+                    raise _NotWrappable
+                self.edit(node,r"%s\s*\[\s*%d\s*\]" % (self.pname,node.slice.value.n),"None")
+                return self.located(ast.Name(id="None",ctx=node.ctx),node)
+        if isinstance(node.ctx,ast.Load):
+            if n: self.used[n] = 1
+        elif isinstance(node.ctx,(ast.Store,ast.AugStore)):
+            if n: raise _NotWrappable
+        else:
+            raise _NotWrappable
+        self.edit(node,r"%s\s*\[\s*%d\s*\]" % (self.pname,node.slice.value.n),"_p%d" % n)
+        return self.located(self.local(n,node.ctx),node)
+
+    def visit_Call(self,node):
+        if (isinstance(node.func,ast.Name) and node.func.id == "len" and len(node.args) == 1
+            and isinstance(node.args[0],ast.Name) and node.args[0].id == self.pname
+            and not (node.keywords or node.starargs or node.kwargs)):
+            self.edit(node,r"len\s*\(\s*%s\s*\)" % self.pname,"%d" % (self.plen + 1))
+            return self.located(ast.Num(n=self.plen + 1),node)
+        return self.generic_visit(node)
+
+    def visit_Name(self,node):
+        if node.id in (self.pname,"_t") or re.match(r"_p\d+$",node.id):
+            raise _NotWrappable
+        return node
+
+    def visit_Return(self,node):
+        if node.value is not None:
+            raise _NotWrappable
+        self.edit(node,r"return\b","return _p0")
+        node.value = self.located(self.local(0,ast.Load()),node)
+        return node
+
+    def visit_FunctionDef(self,node):
+        raise _NotWrappable
+    visit_Lambda = visit_ClassDef = visit_Exec = visit_FunctionDef
+
+# Returns (tree, transformer, lines, start) with the rewritten tree of func,
+# its source lines dedented and the number of lines before them in the file,
+# or None if func can't be wrapped.
+
+def _rewrite_action(func,plen):
+    positions = getattr(func,"positions",None)
+    if positions is not None:
+        func = func.action
+        plen = len(positions) - 1
+    if not isinstance(func,types.FunctionType) or func.func_closure or func.func_defaults:
+        return None
+    # The function ends before the first line that isn't indented deeper than
+    # its def.  Should that line be inside a string or brackets, what's before
+    # it doesn't parse.  The source is padded to keep the line numbers.
+    filename = func.func_code.co_filename
+    lines = linecache.getlines(filename)
+    start = func.func_code.co_firstlineno - 1
+    if start >= len(lines):
+        return None
+    indent = len(lines[start]) - len(lines[start].lstrip())
+    end = start + 1
+    while end < len(lines):
+        line = lines[end].lstrip()
+        if line and line[0] != "#" and len(lines[end]) - len(line) <= indent:
+            break
+        end += 1
+    lines = textwrap.dedent("".join(lines[start:end])).splitlines()
+    try:
+        tree = ast.parse("\n"*start + "\n".join(lines))
+    except (SyntaxError,TypeError):
+        return None
+    fdef = tree.body[0]
+    args = fdef.args
+    if (len(tree.body) != 1 or not isinstance(fdef,ast.FunctionDef) or fdef.name != func.__name__
+        or fdef.decorator_list or args.vararg or args.kwarg or len(args.args) != 1
+        or not isinstance(args.args[0],ast.Name)):
+        return None
+    pname = args.args[0].id
+    body = fdef.body
+    if isinstance(body[0],ast.Expr) and isinstance(body[0].value,ast.Str):
+        body = body[1:]
+    transformer = _ActionTransformer(pname,plen,positions)
+    try:
+        fdef.body[len(fdef.body) - len(body):] = [transformer.visit(stmt) for stmt in body]
+    except _NotWrappable:
+        return None
+    return tree, transformer, lines, start
+
+def lr_wrap_action(func,plen):
+    rewritten = _rewrite_action(func,plen)
+    if not rewritten:
+        return None
+    tree, transformer, lines, start = rewritten
+    fdef = tree.body[0]
+    body = fdef.body
+    if isinstance(body[0],ast.Expr) and isinstance(body[0].value,ast.Str):
+        body = body[1:]
+
+    # _p0 = None; _pn = _t[n].value for the n in use; body; return _p0
+    Load, Store = ast.Load(), ast.Store()
+    at = transformer.located
+    head = [at(ast.Assign(targets=[at(transformer.local(0,Store),fdef)],
+                          value=at(ast.Name(id="None",ctx=Load),fdef)),fdef)]
+    used = transformer.used.keys()
+    used.sort()
+    for n in used:
+        head.append(at(ast.Assign(targets=[at(transformer.local(n,Store),fdef)],
+                                  value=transformer.item(ast.Index(value=at(ast.Num(n=n),fdef)),fdef)),fdef))
+    tail = at(ast.Return(value=at(transformer.local(0,Load),fdef)),fdef)
+    fdef.args.args = [at(ast.Name(id="_t",ctx=ast.Param()),fdef)]
+    fdef.body = head + body + [tail]
+
+    func = getattr(func,"action",func)
+    code = compile(tree,func.func_code.co_filename,"exec")
+    for const in code.co_consts:
+        if isinstance(const,types.CodeType):
+            return types.FunctionType(const,func.func_globals,func.__name__)
+    return None
+
+def lr_action_source(func,plen,name):
+    rewritten = _rewrite_action(func,plen)
+    if not rewritten:
+        return None
+    tree, transformer, lines, start = rewritten
+    func = getattr(func,"action",func)
+    fdef = tree.body[0]
+    first = fdef.body[0].lineno - 1 - start
+    if first == 0 or not re.match(r"def\s+%s\s*\(\s*%s\s*\)\s*:\s*(#.*)?$" % (func.__name__,transformer.pname),lines[0]):
+        return None
+    indent = re.match(r"\s*",lines[first]).group()
+    if isinstance(fdef.body[0],ast.Expr) and isinstance(fdef.body[0].value,ast.Str) and fdef.body[0].col_offset < 0:
+        # A string on several lines has the line number of its last line
+        first = 1
+        indent = re.match(r"\s*",lines[first]).group()
+
+    # Apply the edits from right to left, each has to match where its node is
+    edits = transformer.edits
+    edits.sort()
+    edits.reverse()
+    for lineno, col, pattern, replacement in edits:
+        i = lineno - 1 - start
+        m = re.compile(pattern).match(lines[i],col)
+        if not m:
+            return None
+        lines[i] = lines[i][:col] + replacement + lines[i][m.end():]
+
+    head = ["def %s(_t):" % name, indent + "_p0 = None"]
+    used = transformer.used.keys()
+    used.sort()
+    for n in used:
+        head.append(indent + "_p%d = _t[%d].value" % (n,n))
+    body = lines[first:]
+    while body and not body[-1].strip():
+        del body[-1]
+    return "\n".join(head + body + [indent + "return _p0"]) + "\n"
 
-                continue
+# -----------------------------------------------------------------------------
+# lr_pack_tables()
+#
+# Packs the action and goto dictionaries into flat integer arrays.  Terminals
+# and nonterminals are numbered in sorted order, and each state's row is
+# overlaid on the others at a displacement base[state] (a comb vector).  An
+# entry for (state,symbol) exists only if check[base[state]+symbol] == state.
+# Returns (terms, nonterms, abase, acheck, avalue, gbase, gvalue).  The goto
+# table needs no check array since the parser only asks for gotos that exist.
+# -----------------------------------------------------------------------------
+
+def lr_pack_tables(action,goto):
+    terms = { }
+    for row in action.values():
+        terms.update(row)
+    terms = terms.keys()
+    terms.sort()
+    termids = { }
+    for i in range(len(terms)):
+        termids[terms[i]] = i
+
+    nonterms = { }
+    for row in goto.values():
+        nonterms.update(row)
+    nonterms = nonterms.keys()
+    nonterms.sort()
+    nontermids = { }
+    for i in range(len(nonterms)):
+        nontermids[nonterms[i]] = i
+
+    rows = [ ]
+    for state,row in action.items():
+        rows.append((state,[(termids[name],t) for name,t in row.items()]))
+    abase, acheck, avalue = _comb(rows,len(terms) + 1)
+    rows = [ ]
+    for state,row in goto.items():
+        rows.append((state,[(nontermids[name],t) for name,t in row.items()]))
+    gbase, gcheck, gvalue = _comb(rows,len(nonterms))
+    return (terms, nonterms, abase, acheck, avalue, gbase, gvalue)
 
-            # Call an error function here
-            raise RuntimeError, "yacc: internal parser error!!!\n"
+# -----------------------------------------------------------------------------
+# lr_default_reductions()
+#
+# Finds the states whose every action is a reduction by the same rule.  In
+# such a state the parser reduces no matter what the lookahead is, so it can
+# do so without fetching the next token or looking it up.  An erroneous
+# lookahead is still caught before it is shifted, just a few reductions later.
+# Returns an array with the (negative) rule to reduce by for those states and
+# 0 for all others.
+# -----------------------------------------------------------------------------
+
+def lr_default_reductions(action):
+    nstates = 0
+    for state in action.keys():
+        nstates = max(nstates,state + 1)
+    defaults = array.array('i',[0]*nstates)
+    for state,row in action.items():
+        rules = { }
+        for t in row.values():
+            rules[t] = 1
+        rules = rules.keys()
+        if len(rules) == 1 and rules[0] < 0:
+            defaults[state] = rules[0]
+    return defaults
+
+# -----------------------------------------------------------------------------
+# _comb()
+#
+# Pack the rows of a sparse table into flat arrays by row displacement.  rows
+# is a list of (row number, [(column, value), ...]) pairs.  Each row gets a
+# base such that its entries don't collide with those of the rows placed
+# before it.  Returns arrays base, check and value, where row r has value[i]
+# in column c for i = base[r] + c if check[i] == r.  The arrays are padded so
+# that base[r] + c is a valid index for every column c < ncolumns.
+# -----------------------------------------------------------------------------
+
+def _comb(rows,ncolumns):
+    nrows = 0
+    for r,cols in rows:
+        nrows = max(nrows,r + 1)
+    base = array.array('i',[0]*nrows)
+    check = [ ]
+    value = [ ]
+    free = [ ]                        # Unused indices below len(check)
+    # The fullest rows are the hardest to fit, they are placed first
+    rows = [(-len(cols),r,cols) for r,cols in rows]
+    rows.sort()
+    for n,r,cols in rows:
+        if not cols: continue
+        cols.sort()
+        first = cols[0][0]
+        # Only try the bases that put the first column on a free slot
+        for i in free + [max(len(check),first)]:
+            b = i - first
+            if b < 0: continue
+            for c,v in cols:
+                j = b + c
+                if j < len(check) and check[j] != -1: break
+            else:
+                break
+        for c,v in cols:
+            j = b + c
+            if j >= len(check):
+                free.extend(range(len(check),j))
+                check.extend([-1]*(j + 1 - len(check)))
+                value.extend([0]*(j + 1 - len(value)))
+            check[j] = r
+            value[j] = v
+        base[r] = b
+        free = [j for j in free if check[j] == -1]
+    size = max(base.tolist() + [0]) + ncolumns
+    if len(check) < size:
+        check.extend([-1]*(size - len(check)))
+        value.extend([0]*(size - len(value)))
+    return base, array.array('i',check), array.array('i',value)
 
 # -----------------------------------------------------------------------------
 #                          === Parser Construction ===
@@ -518,7 +971,7 @@ def initialize_vars():
 
     Errorfunc    = None    # User defined error handler
 
-    Signature    = md5.new()   # Digital signature of the grammar rules, precedence
+    Signature    = hashlib.md5()   # Digital signature of the grammar rules, precedence
                                # and other information.  Used to determined when a
                                # parsing table needs to be regenerated.
 
@@ -1169,11 +1622,12 @@ def compute_first1():
 
 # Global variables for the LR parsing engine
 def lr_init_vars():
-    global _lr_action, _lr_goto, _lr_method
+    global _lr_action, _lr_goto, _lr_method, _lr_packed
     global _lr_goto_cache, _lr0_cidhash
     
     _lr_action       = { }        # Action table
     _lr_goto         = { }        # Goto table
+    _lr_packed       = None       # Action and goto tables as arrays
     _lr_method       = "Unknown"  # LR method used
     _lr_goto_cache   = { }
     _lr0_cidhash     = { }
@@ -1935,6 +2389,18 @@ del _lr_goto_items
             else:
                 f.write("  None,\n")
         f.write("]\n")
+
+        # Write the packed tables
+        terms, nonterms, abase, acheck, avalue, gbase, gvalue = _lr_packed
+        f.write("\n_lr_packed_items = (%r,%r,\n" % (terms, nonterms))
+        for a in (abase, acheck, avalue, gbase, gvalue):
+            f.write("  %r,\n" % a.tolist())
+        f.write(""")
+
+import array as _array
+_lr_packed = _lr_packed_items[:2] + tuple([_array.array('i',_a) for _a in _lr_packed_items[2:]])
+del _lr_packed_items, _array
+""")
         
         f.close()
 
@@ -1944,7 +2410,7 @@ del _lr_goto_items
         return
 
 def lr_read_tables(module=tab_module,optimize=0):
-    global _lr_action, _lr_goto, _lr_productions, _lr_method
+    global _lr_action, _lr_goto, _lr_productions, _lr_method, _lr_packed
     try:
         exec "import %s as parsetab" % module
         
@@ -1953,6 +2419,7 @@ def lr_read_tables(module=tab_module,optimize=0):
             _lr_goto   = parsetab._lr_goto
             _lr_productions = parsetab._lr_productions
             _lr_method = parsetab._lr_method
+            _lr_packed = getattr(parsetab,"_lr_packed",None)
             return 1
         else:
             return 0
@@ -1961,6 +2428,203 @@ def lr_read_tables(module=tab_module,optimize=0):
         return 0
 
 
+# -----------------------------------------------------------------------------
+# lr_write_parser()
+#
+# Writes a parser as a standalone module.  The module holds the packed
+# tables, the grammar rules compiled into reduction functions (see
+# lr_action_source()) and a parser class over them, and doesn't need yacc()
+# or the grammar's docstrings at run time.  The parse loop and the rule
+# signature are copied from the source of Parser and lr_rule_signature(),
+# so both parsers always run the same code.  Its bind(module) returns
+# a parser whose reductions run in the namespace of the grammar module, or
+# None if the grammar or the code of a compiled rule has changed since the
+# module was written.  Rules that can't be compiled are called with a
+# YaccProduction as usual.
+# -----------------------------------------------------------------------------
+
+def lr_write_parser(parser,modulename,outputdir=''):
+    filename = os.path.join(outputdir,modulename) + ".py"
+    f = lex._AtomicFile(filename)
+    f.write("""
+# %s.py
+# This file is automatically generated by ply.yacc.lr_write_parser().
+# Do not edit.
+
+_lr_method = %r
+
+_lr_signature = %r
+
+error_count = %d
+
+import array, hashlib, sys, types
+from ply import lex
+
+_termids = %r
+_unknownid = %d
+""" % (modulename, parser.method, parser.signature, error_count, parser.termids, parser.unknownid))
+    for name in ("abase","acheck","avalue","gbase","gvalue","defaults"):
+        f.write("_%s = array.array('i',%r)\n" % (name,getattr(parser,name).tolist()))
+
+    # One reduction function per rule and production length
+    reductions = { }
+    for p in parser.productions:
+        if not p or not p.func: continue
+        key = (p.func,p.len)
+        if reductions.has_key(key): continue
+        name = "_r%d" % p.number
+        source = lr_action_source(p.func,p.len,name)
+        if source:
+            action = getattr(p.func,"action",p.func)
+            f.write("\n# %s, %s:%d\n" % (action.__name__,os.path.basename(action.func_code.co_filename),
+                                          action.func_code.co_firstlineno))
+            f.write(source)
+        else:
+            name = None
+        reductions[key] = name
+
+    # The rules with a reduction function and a hash of their code
+    rules = [ ]
+    for p in parser.productions:
+        if p and p.func and reductions[(p.func,p.len)] and p.func not in rules:
+            rules.append(p.func)
+    f.write("\n_lr_rules = %r\n" % (tuple([r.__name__ for r in rules]),))
+    f.write("_lr_rulesig = %r\n" % lr_rule_signature(rules))
+
+    # (name, length, goto column, rule, reduction, text)
+    f.write("\n_productions = [\n")
+    for p in parser.productions:
+        if not p:
+            f.write("  None,\n")
+        elif not p.func:
+            f.write("  (%r,%d,%d,None,None,%r),\n" % (p.name,p.len,p.nid,str(p)))
+        else:
+            f.write("  (%r,%d,%d,%r,%s,%r),\n" % (p.name,p.len,p.nid,p.func.__name__,
+                                                  reductions[(p.func,p.len)],str(p)))
+    f.write("]\n")
+
+    # The code shared with this module, copied from its source
+    f.write(_standalone_header)
+    for func in (_code_signature,lr_rule_signature):
+        f.write("\n" + inspect.getsource(func))
+    f.write(_standalone_parser)
+    for method in (Parser.errok,Parser.restart,Parser.parse,Parser.dumptrace):
+        f.write("\n" + inspect.getsource(method))
+    f.close()
+
+# -----------------------------------------------------------------------------
+# lr_rule_signature()
+#
+# Return a hash of the code of the rule functions funcs, or of their actions
+# and positions.  The standalone parser runs copies of the rule bodies, so it
+# has to be written again when a body changes even if the grammar itself stays
+# the same.
+# -----------------------------------------------------------------------------
+
+def _code_signature(sig,code):
+    sig.update(code.co_code)
+    sig.update(repr((code.co_names,code.co_varnames,code.co_freevars)))
+    for c in code.co_consts:
+        if isinstance(c,types.CodeType):
+            _code_signature(sig,c)
+        else:
+            sig.update(repr(c))
+
+def lr_rule_signature(funcs):
+    sig = hashlib.md5()
+    for f in funcs:
+        sig.update(f.__name__)
+        positions = getattr(f,"positions",None)
+        if positions is not None:
+            sig.update(repr(positions))
+            f = f.action
+        _code_signature(sig,f.func_code)
+    return sig.digest()
+
+_standalone_header = r'''
+class YaccSymbol(object):
+    __slots__ = ('type','value','lexpos','endlexpos')
+    def __str__(self):    return self.type
+    def __repr__(self):   return str(self)
+
+# Only the rules without a reduction function need ply.yacc
+def YaccProduction(s):
+    from ply.yacc import YaccProduction
+    return YaccProduction(s)
+
+# The names in module, in the order yacc() sees them
+def _ldict(module):
+    if isinstance(module,types.ModuleType):
+        return module.__dict__
+    ldict = { }
+    for k in dir(module):
+        ldict[k] = getattr(module,k)
+    return ldict
+
+# The signature yacc() gives the grammar in module
+def _signature(module):
+    sig = hashlib.md5()
+    sig.update(_lr_method)
+    start = getattr(module,"start",None)
+    if start:
+        sig.update(start)
+    prec = getattr(module,"precedence",None)
+    if prec:
+        sig.update(repr(prec))
+    symbols = [f for f in _ldict(module).values()
+               if type(f) in (types.FunctionType,types.MethodType)
+               and f.__name__[:2] == 'p_' and f.__name__ != 'p_error']
+    symbols.sort(lambda x,y: cmp(x.func_code.co_firstlineno,y.func_code.co_firstlineno))
+    for f in symbols:
+        if f.__doc__:
+            sig.update(f.__doc__)
+    return sig.digest()
+
+def bind(module):
+    if _signature(module) != _lr_signature:
+        return None
+    rules = [getattr(module,name,None) for name in _lr_rules]
+    if None in rules or lr_rule_signature(rules) != _lr_rulesig:
+        return None
+    return Parser(module)
+'''
+
+_standalone_parser = r'''
+class Parser:
+    def __init__(self,module):
+        self.errorfunc = getattr(module,"p_error",None)
+        self.method = _lr_method
+        self.trace = None
+        self.errorok = 0
+        self.termids = _termids
+        self.unknownid = _unknownid
+        self.abase = _abase
+        self.acheck = _acheck
+        self.avalue = _avalue
+        self.gbase = _gbase
+        self.gvalue = _gvalue
+        self.defaults = _defaults
+        # (length, goto column, name, reduction) and the rule function for
+        # the rules that have no reduction
+        n = len(_productions)
+        self.reductions = [None]*n
+        self.rules = [None]*n
+        self.texts = [None]*n
+        self.unwrapped = 0
+        for i in range(n):
+            if not _productions[i]: continue
+            name, plen, nid, rule, reduction, text = _productions[i]
+            self.texts[i] = text
+            if rule:
+                f = getattr(module,rule)
+                if reduction:
+                    reduction = types.FunctionType(reduction.func_code,f.func_globals,rule)
+                else:
+                    self.rules[i] = f
+                    self.unwrapped = 1
+            self.reductions[i] = (plen,nid,name,reduction)
+'''
+
 # -----------------------------------------------------------------------------
 # yacc(module)
 #
@@ -1968,7 +2632,7 @@ def lr_read_tables(module=tab_module,optimize=0):
 # -----------------------------------------------------------------------------
 
 def yacc(method=default_lr, debug=yaccdebug, module=None, tabmodule=tab_module, start=None, check_recursion=1, optimize=0,write_tables=1,debugfile=debug_file,outputdir=''):
-    global yaccdebug
+    global yaccdebug, _lr_packed
     yaccdebug = debug
     
     initialize_vars()
@@ -2164,6 +2828,8 @@ def yacc(method=default_lr, debug=yaccdebug, module=None, tabmodule=tab_module,
             else:
                 raise YaccError, "Unknown parsing method '%s'" % method
 
+            _lr_packed = lr_pack_tables(_lr_action,_lr_goto)
+
             if write_tables:
                 lr_write_tables(tabmodule,outputdir)        
     
@@ -2187,6 +2853,17 @@ def yacc(method=default_lr, debug=yaccdebug, module=None, tabmodule=tab_module,
     p.goto   = _lr_goto
     p.method = _lr_method
     p.require = Requires
+    p.signature = Signature.digest()
+    p.settables(_lr_packed)
+
+    # Tell which rules are left to the slower YaccProduction calls
+    if yaccdebug and wrap_actions:
+        plain = [ ]
+        for prod in p.productions:
+            if prod and prod.func and not prod.call and prod.func.__name__ not in plain:
+                plain.append(prod.func.__name__)
+        if plain:
+            print >>sys.stderr, "yacc: %d rules not compiled into reduction wrappers: %s" % (len(plain),", ".join(plain))
 
     global parse
     parse = p.parse
@@ -2203,8 +2880,8 @@ def yacc(method=default_lr, debug=yaccdebug, module=None, tabmodule=tab_module,
 # used during table construction
 
 def yacc_cleanup():
-    global _lr_action, _lr_goto, _lr_method, _lr_goto_cache
-    del _lr_action, _lr_goto, _lr_method, _lr_goto_cache
+    global _lr_action, _lr_goto, _lr_method, _lr_goto_cache, _lr_packed
+    del _lr_action, _lr_goto, _lr_method, _lr_goto_cache, _lr_packed
 
     global Productions, Prodnames, Prodmap, Terminals 
     global Nonterminals, First, Follow, Precedence, LRitems
@@ -1,27 +1,448 @@
 #!/usr/bin/env python
 
-from indentphp import indentfile
+from indentphp import indentfile, dumptokens, tokenbuffer, Formatter
+from ply.lex import LexError, LineIndex
+from ply import lex, yacc
+import indentphp
 import unittest
 from glob import glob
 from commands import getoutput, mkarg
 from os import unlink
+from os.path import join
+from tempfile import mkdtemp
+from shutil import rmtree
+import imp
+import inspect
+from subprocess import Popen, PIPE
+from StringIO import StringIO
+import sys
+import copy
+import re
+import json
 
 class TestIndentPHP(unittest.TestCase):
     def testall(self):
+        self.checkall()
+
+    def testtrivia(self):
+        self.checkall(trivia=True)
+
+    def testtriviaattachment(self):
+        # the whitespace between two tokens is split at the first line break
+        # into trailing trivia of the one and leading trivia of the other,
+        # and together the tokens and their trivia cover the source
+        s = '<?php\n$a = 1;  // x\n\n  $b = 2; ?>\n'
+        buffer = tokenbuffer(s)
+        reader = buffer.reader(indentphp.token_values, indentphp.TRIVIA)
+        texts = []
+        tok = reader.token()
+        while tok:
+            i = reader.find(tok)
+            texts.append((s[slice(*reader.leading(i))], buffer.text(i),
+                          s[slice(*reader.trailing(i))]))
+            tok = reader.token()
+        self.assertEqual(texts[5:7], [('', '// x', '\n'), ('\n  ', '$b', ' ')])
+        self.assertEqual(''.join([''.join(t) for t in texts]), s)
+
+    def testdfa(self):
+        self.checkall(usedfa=True)
+
+    def testformatmany(self):
+        # one formatter for all files gives the same as indentfile
+        files = glob('tests/???-*.php')
+        files.sort()
+        files = [f for f in files if open(f).read()]
+        texts = [open(f).read() for f in files]
+        for filename, res in zip(files, Formatter().format_many(texts)):
+            self.assertEqual(res, open('tests/expected' + filename[5:]).read(),
+                             filename)
+
+    def testtrace(self):
+        # a syntax error writes the last parser actions, ending in the error
+        formatter = Formatter(trace=4)
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            formatter.format('<?php\nif ( { }\n?>\n')
+            lines = sys.stderr.getvalue().splitlines()
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(lines[0], 'Syntax error on line 2, column 6')
+        self.assertEqual(lines[1], 'last 4 parser actions:')
+        self.assertEqual(len(lines), 6)
+        self.assert_(lines[-1].endswith('LBRACE               syntax error'), lines[-1])
+
+    def testparsererror(self):
+        # the parsers report syntax errors outside a Formatter too, and
+        # formatters don't report each other's errors
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            Formatter(trace=4)
+            for p in (indentphp.parser, yacc.yacc(module=indentphp, debug=0)):
+                p.parse('<?php\nif ( { }\n?>\n', lexer=indentphp.lexer.clone())
+            lines = sys.stderr.getvalue().splitlines()
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(lines, ['Syntax error at index 11'] * 2)
+
+    def teststream(self):
+        # tokens cut by chunk boundaries come out as from the whole file
+        files = glob('tests/???-*.php') + glob('tests/expected/???-*.php')
+        files.sort()
+        for filename in files:
+            s = open(filename).read()
+            whole = StringIO()
+            dumptokens(StringIO(s), whole, chunksize=len(s) + 1)
+            for chunksize in (1, 3, 64):
+                out = StringIO()
+                dumptokens(StringIO(s), out, chunksize=chunksize)
+                self.assertEqual(out.getvalue(), whole.getvalue(),
+                                 '%s, chunksize %d' % (filename, chunksize))
+
+    def teststreamerror(self):
+        # lexing errors past the first chunk are reported at their line and
+        # offset in the whole input, on stderr
+        s = '<?php\n' + '$a = 1;\n' * 100 + '$b = "abc\n'
+        for usedfa in (False, True):
+            stderr = sys.stderr
+            sys.stderr = StringIO()
+            out = StringIO()
+            try:
+                try:
+                    dumptokens(StringIO(s), out, usedfa=usedfa, chunksize=64)
+                    message = None
+                except LexError, e:
+                    message = e.args[0]
+                lines = sys.stderr.getvalue().splitlines()
+            finally:
+                sys.stderr = stderr
+            self.assertEqual(lines, ['lexing error in php on line 102, column 6'])
+            self.assertEqual(message, 'Unterminated string starting at index %d'
+                                      % s.index('"'))
+            self.assert_('lexing error' not in out.getvalue())
+
+    def testcheck(self):
+        # --check lists the files that are not indented on stdout, errors go
+        # to stderr, and the exit status tells whether any were listed
+        tmpdir = mkdtemp()
+        try:
+            indented = join(tmpdir, 'a.php')
+            unindented = join(tmpdir, 'b.php')
+            broken = join(tmpdir, 'c.php')
+            open(indented, 'w').write(open('tests/expected/008-if.php').read())
+            open(unindented, 'w').write(open('tests/008-if.php').read())
+            open(broken, 'w').write('<?php\nif ( { }\n?>\n')
+            for names, out, status in (([indented], [], 0),
+                                       ([tmpdir], [unindented, broken], 1)):
+                p = Popen([sys.executable, 'indentphp.py', '--check'] + names,
+                          stdout=PIPE, stderr=PIPE)
+                stdout, stderr = p.communicate()
+                self.assertEqual((stdout.splitlines(), p.returncode), (out, status))
+            self.assert_('Syntax error on line 2, column 6' in stderr, stderr)
+        finally:
+            rmtree(tmpdir)
+
+    def testlextab(self):
+        # lextab.py is written again when a token rule changes, and a
+        # directory it can't be written to only costs a warning
+        def lexer(number, outputdir):
+            module = imp.new_module('lextabtest')
+            module.tokens = ('NUMBER',)
+            module.t_NUMBER = number
+            module.t_ignore = ' '
+            def t_error(t):
+                pass
+            module.t_error = t_error
+            return lex.lex(module=module, optimize=1, lextab='lextab_test',
+                           outputdir=outputdir)
+        def tokens(lexer, s):
+            lexer.input(s)
+            return [(t.type, t.value) for t in iter(lexer.token, None)]
+        tmpdir = mkdtemp()
+        sys.path.insert(0, tmpdir)
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            def written():
+                tab = {}
+                execfile(join(tmpdir, 'lextab_test.py'), tab)
+                return tab['_lexstatere']['INITIAL'][0][0]
+            lexer(r'\d+', tmpdir)
+            self.assertEqual(written(), r'(?P<t_NUMBER>\d+)')
+            self.assertEqual(tokens(lexer(r'\d', tmpdir), '12'),
+                             [('NUMBER', '1'), ('NUMBER', '2')])
+            self.assertEqual(written(), r'(?P<t_NUMBER>\d)')
+            self.assertEqual(tokens(lexer(r'[0-9]+', join(tmpdir, 'missing')), '12'),
+                             [('NUMBER', '12')])
+            self.assert_("Couldn't create 'lextab_test'" in sys.stderr.getvalue())
+        finally:
+            sys.stderr = stderr
+            sys.path.remove(tmpdir)
+            sys.modules.pop('lextab_test', None)
+            rmtree(tmpdir)
+
+    def testlineindex(self):
+        # \r\n, \n and a lone \r each end a line, a line starts right after
+        # its line break and the end of the input is on the last line
+        for data in ('ab\r\ncd\ref\ng', 'ab\ncd\nef\ng', 'ab\rcd\ref\rg'):
+            lines = LineIndex(data)
+            c = data.index('c')
+            e = data.index('e')
+            g = data.index('g')
+            self.assertEqual(len(lines), 4, repr(data))
+            self.assertEqual([lines.position(i) for i in (0, 1, 2, c, c + 2, e, g, len(data))],
+                             [(1, 1), (1, 2), (1, 3), (2, 1), (2, 3), (3, 1), (4, 1), (4, 2)],
+                             repr(data))
+            self.assertEqual(lines.lineno(c - 1), 1, repr(data))
+        self.assertEqual(LineIndex('ab\r\n').position(3), (1, 4))
+        self.assertEqual(LineIndex('ab\r\n').position(4), (2, 1))
+        self.assertEqual(LineIndex('').position(0), (1, 1))
+        # an index of a part of the input starting at line 5, column 3
+        self.assertEqual([LineIndex('ab\ncd', 5, 3).position(i) for i in (0, 2, 3, 5)],
+                         [(5, 3), (5, 5), (6, 1), (6, 3)])
+
+    def testlinenumbers(self):
+        # line numbers are looked up from lexpos in the LineIndex of the lexer
+        s = '<?php\n\n\n$a = 1;\n?>\n'
+        mylexer = indentphp.lexer.clone()
+        mylexer.input(s)
+        tokens = mylexer.tokenize()
+        p = yacc.YaccProduction(tokens)
+        p.lexer = mylexer
+        self.assertEqual([p.lineno(i) for i in range(len(tokens))],
+                         [s.count('\n', 0, tok.lexpos) + 1 for tok in tokens])
+        self.assertEqual(p.linespan(1), (1, 1))
+        self.assertEqual(p.lineno(2), 4)
+        parser = copy.copy(indentphp.parser)
+        parser.errorfunc = None
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            parser.parse('<?php\n\n\nif ( { }\n?>\n', lexer=indentphp.lexer.clone())
+            lines = sys.stderr.getvalue().splitlines()
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(lines[0], 'yacc: Syntax error at line 4, token=LBRACE')
+
+    def testtokenformats(self):
+        # token texts with tabs, line breaks, backslashes and non-ASCII bytes
+        # come back unchanged from both --tokens formats
+        literal = "'a\tb\nc\r\nd\\\\e\\n \xc3\xa9'"
+        s = '<?php\n$a = %s;\n?>\n' % literal
+        unescapes = {'t': '\t', 'n': '\n', 'r': '\r', '\\': '\\'}
+        for format in ('tsv', 'jsonl'):
+            out = StringIO()
+            dumptokens(StringIO(s), out, format)
+            texts = []
+            for line in out.getvalue().splitlines():
+                if format == 'tsv':
+                    type, start, end, lineno, text = line.split('\t')
+                    text = re.sub(r'\\(.)', lambda m: unescapes[m.group(1)], text)
+                else:
+                    token = json.loads(line)
+                    start, end = token['start'], token['end']
+                    text = token['text'].encode('utf-8')
+                self.assertEqual(text, s[int(start):int(end)], format)
+                texts.append(text)
+            self.assertEqual(''.join(texts), s, format)
+            self.assert_(literal in texts, format)
+
+    def testpackedtables(self):
+        # the comb arrays give every action and goto of the table dicts, and
+        # no action where the dicts have none
+        for module, tabmodule in ((indentphp, 'parsetab'),
+                                  (indentphp.TriviaGrammar(), 'parsetab_trivia')):
+            parser = yacc.yacc(module=module, debug=0, tabmodule=tabmodule)
+            abase, acheck, avalue = parser.abase, parser.acheck, parser.avalue
+            for state in range(len(abase)):
+                row = parser.action.get(state, {})
+                for term, tid in parser.termids.items():
+                    i = abase[state] + tid
+                    if acheck[i] == state:
+                        self.assertEqual(avalue[i], row[term], (state, term))
+                    else:
+                        self.assert_(term not in row, (state, term))
+                self.assertNotEqual(acheck[abase[state] + parser.unknownid], state)
+                if parser.defaults[state]:
+                    self.assertEqual(set(row.values()), set([parser.defaults[state]]))
+                elif row:
+                    self.assert_(len(set(row.values())) > 1 or row.values()[0] >= 0, state)
+            nontermids = {}
+            for p in parser.productions[1:]:
+                nontermids[p.name] = p.nid
+            for state, row in parser.goto.items():
+                for name, t in row.items():
+                    self.assertEqual(parser.gvalue[parser.gbase[state] + nontermids[name]], t)
+
+    def testdefaultreductions(self):
+        # reducing without a lookahead still finds a syntax error at the
+        # token where the parser that always looks ahead finds it
+        tableparser = yacc.yacc(module=indentphp, debug=0)
+        lookahead = copy.copy(tableparser)
+        lookahead.defaults = [0] * len(tableparser.defaults)
+        errors = []
+        def error(p):
+            errors.append(p and (p.type, p.lexpos))
+        sources = ('<?php\nif ( { }\n?>\n', '<?php $a = ; ?>', '<?php foo($a $b); ?>',
+                   '<?php function f( { } ?>', '<?php $a[1 = 2; ?>', '<?php $a ? ; ?>',
+                   '<?php return $a $b; ?>', '<?php $a = (1', '<?php $a = !; ?>')
+        for s in sources:
+            found = []
+            for p in (lookahead, copy.copy(tableparser), copy.copy(indentphp.parser)):
+                del errors[:]
+                p.errorfunc = error
+                trace = []
+                p.parse(s, lexer=indentphp.lexer.clone(), trace=trace)
+                found.append(errors[0])
+            self.assertEqual(found, [found[0]] * 3, s)
+            self.assert_('$default' in [ltype for state, ltype, t in trace], s)
+
+    def testwrappedactions(self):
+        # every rule of both grammars is called through a compiled wrapper
+        for module, tabmodule in ((indentphp, 'parsetab'),
+                                  (indentphp.TriviaGrammar(), 'parsetab_trivia')):
+            parser = yacc.yacc(module=module, debug=0, tabmodule=tabmodule)
+            self.assertEqual([p.func.__name__ for p in parser.productions[1:]
+                              if not p.call], [])
+
+    def teststandalone(self):
+        # the parser from yacc and the one written as a module format alike
+        tableparser = yacc.yacc(module=indentphp, debug=0)
+        outputdir = mkdtemp()
+        try:
+            yacc.lr_write_parser(tableparser, 'phpparser_test', outputdir)
+            module = imp.load_source('phpparser_test',
+                                     join(outputdir, 'phpparser_test.py'))
+            # it runs the parse loop of yacc's parser, not a copy of its own
+            for name in ('errok', 'restart', 'parse', 'dumptrace'):
+                self.assertEqual(inspect.getsource(getattr(module.Parser, name)),
+                                 inspect.getsource(getattr(yacc.Parser, name)))
+        finally:
+            rmtree(outputdir)
+        files = glob('tests/???-*.php')
+        files.sort()
+        formatter = Formatter()
+        for parser in (tableparser, module.bind(indentphp)):
+            formatter.parser = parser
+            for filename in files:
+                self.assertEqual(formatter.format(open(filename).read()),
+                                 open('tests/expected' + filename[5:]).read(),
+                                 filename)
+
+    def teststalestandalone(self):
+        # the standalone parser doesn't bind to a grammar whose rule bodies
+        # have changed since it was written
+        tableparser = yacc.yacc(module=indentphp, debug=0)
+        outputdir = mkdtemp()
+        try:
+            yacc.lr_write_parser(tableparser, 'phpparser_stale', outputdir)
+            module = imp.load_source('phpparser_stale',
+                                     join(outputdir, 'phpparser_stale.py'))
+        finally:
+            rmtree(outputdir)
+        self.assertNotEqual(module.bind(indentphp), None)
+        edited = imp.new_module('edited')
+        edited.__dict__.update(indentphp.__dict__)
+        rule = indentphp.p_atom_1
+        # same docstring on the same line, different body
+        source = '\n' * (rule.func_code.co_firstlineno - 1) + \
+                 'def p_atom_1(p):\n    %r\n    p[0] = Scalar(p[1].upper())\n' % rule.__doc__
+        exec compile(source, rule.func_code.co_filename, 'exec') in edited.__dict__
+        self.assertEqual(yacc.yacc(module=edited, debug=0).signature,
+                         tableparser.signature)
+        self.assertEqual(module.bind(edited), None)
+
+    def testoperationtree(self):
+        # operators group by the precedence table, not by the LR grammar
+        def shape(e):
+            if isinstance(e, indentphp.OperationExpr):
+                return '(%s %s %s)' % (shape(e.lhs), e.op, shape(e.rhs))
+            if isinstance(e, indentphp.UnaryExpr):
+                return '(%s%s)' % (e.op, shape(e.expr))
+            if isinstance(e, indentphp.AtExpr):
+                return '(@%s)' % shape(e.expr)
+            if isinstance(e, indentphp.AssignExpr):
+                return '(%s = %s)' % (shape(e.lhs), shape(e.expr))
+            if isinstance(e, indentphp.TernaryIfExpr):
+                return '(%s ? %s : %s)' % (shape(e.cond), shape(e.body_true),
+                                           shape(e.body_false))
+            return e.out(None)
+        for s, expected in (
+                ('$a || $b && $c == $d . $e', '($a || ($b && ($c == ($d . $e))))'),
+                ('$a . $b == $c && $d || $e', '(((($a . $b) == $c) && $d) || $e)'),
+                ('$a . $b . $c', '(($a . $b) . $c)'),
+                ('!$a . -$b', '((!$a) . (-$b))'),
+                ('@$a == $b', '((@$a) == $b)'),
+                ('$a = $b = $c || $d', '($a = ($b = ($c || $d)))'),
+                ('$a && $b = $c || $d', '($a && ($b = ($c || $d)))'),
+                ('$a ? $b : $c ? $d : $e', '(($a ? $b : $c) ? $d : $e)'),
+                ('$a || $b ? $c . $d : $e', '(($a || $b) ? ($c . $d) : $e)')):
+            tree = indentphp.parser.parse('<?php %s; ?>' % s,
+                                          lexer=indentphp.lexer.clone())
+            statement = tree.parts[0].statement_list.statement_list[0]
+            self.assertEqual(shape(statement.expr), expected, s)
+
+    def testtokenize(self):
+        # tokenize() and tokenbuffer() lex like calling token() in a loop
+        files = glob('tests/???-*.php')
+        files.sort()
+        for filename in files:
+            s = open(filename).read()
+            for usedfa in (False, True):
+                mylexer = indentphp.newlexer(usedfa)
+                mylexer.input(s)
+                expected = []
+                tok = mylexer.token()
+                while tok:
+                    expected.append((tok.type, str(tok.value), tok.lexpos))
+                    tok = mylexer.token()
+                mylexer = indentphp.newlexer(usedfa)
+                mylexer.input(s)
+                self.assertEqual([(tok.type, str(tok.value), tok.lexpos)
+                                  for tok in mylexer.tokenize()], expected, filename)
+                buffer = tokenbuffer(s, usedfa)
+                self.assertEqual([(buffer.type(i), buffer.starts[i])
+                                  for i in range(len(buffer))],
+                                 [(t[0], t[2]) for t in expected], filename)
+
+    def testrelex(self):
+        # relexing after an edit gives the tokens of lexing from scratch
+        files = glob('tests/???-*.php')
+        files.sort()
+        for filename in files:
+            s = open(filename).read()
+            edits = [open('tests/expected' + filename[5:]).read()]
+            for text in ('x', '<?', '?>', '/*', '"'):
+                for i in (0, len(s) / 2, len(s)):
+                    edits.append(s[:i] + text + s[i:])
+            for usedfa in (False, True):
+                previous = tokenbuffer(s, usedfa)
+                for edit in edits:
+                    try:
+                        expected = tokenbuffer(edit, usedfa)
+                    except LexError:
+                        continue
+                    buffer = tokenbuffer(edit, usedfa, previous)
+                    self.assertEqual((buffer.types, buffer.starts, buffer.ends),
+                                     (expected.types, expected.starts, expected.ends),
+                                     '%s edited to %r' % (filename, edit))
+
+    def checkall(self, **kw):
         files = glob('tests/???-*.php')
         files.sort()
         for infilename in files:
             outfilename = 'tests/out%s' % infilename[5:]
             expectedfilename = 'tests/expected%s' % infilename[5:]
 
-            indentfile(infilename, outfilename)
+            indentfile(infilename, outfilename, **kw)
             output = getoutput('LC_ALL=C diff -u %s %s' % (mkarg(outfilename),  
                                                  mkarg(expectedfilename)))
 
             unlink(outfilename)
             self.assertEqual(output, '', "\n" + output)
 
-            indentfile(expectedfilename, outfilename)
+            indentfile(expectedfilename, outfilename, **kw)
             output = getoutput('LC_ALL=C diff -u %s %s' % (mkarg(outfilename),  
                                                  mkarg(expectedfilename)))
             unlink(outfilename)
@@ -0,0 +1,4 @@
+<p>a < b &lt; c</p>
+<script>if (a<b) {}</script>
+<?php ;?>
+<
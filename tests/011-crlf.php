@@ -0,0 +1,7 @@
+<?php
+function foo()
+{
+	return $a;
+
+}
+?>
@@ -0,0 +1,10 @@
+<?php
+$a='it\'s';
+$a   =   '\\';
+$a = '$not_a_variable';
+$a = "\$escaped";
+$a = "tab\there \"quoted\" \\";
+$a = 'multi
+line';
+$a = "?>";
+?>
@@ -0,0 +1,6 @@
+<p>a < b &lt; c</p>
+<script>if (a<b) {}</script>
+<?php
+;
+?>
+<
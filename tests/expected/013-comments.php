@@ -0,0 +1,38 @@
+<?php
+// leading comment
+# hash comment
+/**
+ * Docblock for foo.
+ *
+ * @param $a something
+ */
+function foo($a)
+{
+    $a = 1; // trailing comment
+    /* block
+          keeps relative indentation
+       of plain lines */
+    return $a;
+}
+
+foo(1); # after a function
+
+class A
+{
+    var $a; # trailing
+
+    /**
+     * Method docs.
+     */
+    function b()
+    {
+    }
+
+    /** more */
+    function c()
+    {
+    }
+    // last
+}
+$x = 1; // before close
+?>